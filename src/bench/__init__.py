@@ -0,0 +1,10 @@
+"""Benchmarks for the api, run with `python -m bench` from src.
+
+The api runs in process against a scratch Neo4j database with local
+stand-ins for the snowflake and auth hosts, see `python -m bench --help`.
+"""
+import os
+import sys
+
+# the api's modules import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rest'))
@@ -0,0 +1,72 @@
+"""Run the benchmarks, results are written as JSON"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+from aiohttp import ClientSession
+from .report import RoundTripCounter, write_results, compare
+from .scenarios import Bench, SCENARIOS
+from .serve import add_arguments, start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__)
+    add_arguments(parser)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated, from ' + ', '.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--sockets', type=int, default=100,
+                        help='gateway connections for the fan-out and reconnect scenarios')
+    parser.add_argument('--rounds', type=int, default=3, help='reconnect storm rounds')
+    parser.add_argument('--output', help='write results here instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    args = parser.parse_args()
+    if not args.db_url:
+        parser.error('--db-url or BENCH_DB_URL is required')
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios {", ".join(sorted(unknown))}')
+    return args
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def run(args):
+    api = await start(args)
+    counter = RoundTripCounter()
+    counter.install()
+    results = []
+    try:
+        async with ClientSession() as session:
+            bench = Bench(session, api.api_url, api.ws_url, api.dataset, counter,
+                          random.Random(args.seed), requests=args.requests,
+                          concurrency=args.concurrency, sockets=args.sockets,
+                          rounds=args.rounds)
+            for name in args.scenarios.split(','):
+                for measurement in await SCENARIOS[name](bench):
+                    results.append(measurement.result())
+    finally:
+        counter.uninstall()
+        await api.close()
+    config = {k: v for k, v in vars(args).items() if k not in ('db_url', 'output', 'compare')}
+    write_results(results, args.output, revision=git_revision(), config=config)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""A minimal gateway client"""
+import asyncio
+import json
+from time import perf_counter
+from urllib.parse import urlsplit
+import websockets
+
+
+def _with_port(url, port):
+    parts = urlsplit(url)
+    return parts._replace(netloc=f'{parts.hostname}:{port}').geturl()
+
+
+class GatewayClient:
+    """Identifies with a token, keeps heartbeating and hands every dispatch to
+    `on_dispatch(client, message, received_at)`. A redirect to another shard
+    (op 7) is followed once.
+
+    `close_code` is set once the connection is closed, by either side, and
+    `on_close(client)` is called if the connection was ready by then.
+    """
+
+    def __init__(self, url, token, on_dispatch=None, heartbeat_interval=None, on_close=None):
+        self.url = url
+        self.token = token
+        self.on_dispatch = on_dispatch
+        self.on_close = on_close
+        # overrides the interval from hello, for testing the rate limits
+        self.heartbeat_interval = heartbeat_interval
+        self.websocket = None
+        self.ready = None
+        self.close_code = None
+        self.close_reason = None
+        self.redirects = 0
+        self._heartbeat_task = None
+        self._read_task = None
+
+    async def connect(self):
+        """Open the connection and identify, returns the seconds it took to
+        get READY including following a redirect to the user's shard"""
+        start = perf_counter()
+        url = self.url
+        while True:
+            self.websocket = await websockets.connect(url, max_size=None)
+            hello = json.loads(await self.websocket.recv())
+            interval = self.heartbeat_interval or hello['d']['heartbeat_interval'] / 1000
+            await self.websocket.send(json.dumps({'op': 2, 'd': {'token': self.token}}))
+            try:
+                while True:
+                    message = json.loads(await self.websocket.recv())
+                    if message.get('t') == 'READY':
+                        break
+                    if message.get('op') == 7 and not self.redirects:
+                        break
+            except websockets.ConnectionClosed:
+                self.close_code = self.websocket.close_code
+                self.close_reason = self.websocket.close_reason
+                raise
+            if message.get('op') != 7:
+                break
+            # another shard has this user, it closes with 4013 after this
+            await self.websocket.close()
+            self.redirects += 1
+            url = _with_port(url, message['d']['port'])
+        self.url = url
+        self.ready = message['d']
+        elapsed = perf_counter() - start
+        self._heartbeat_task = asyncio.ensure_future(self._heartbeat(interval))
+        self._read_task = asyncio.ensure_future(self._read())
+        return elapsed
+
+    async def _heartbeat(self, interval):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.websocket.send(json.dumps({'op': 1}))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _read(self):
+        try:
+            async for data in self.websocket:
+                received_at = perf_counter()
+                message = json.loads(data)
+                if message.get('op') == 0 and self.on_dispatch is not None:
+                    self.on_dispatch(self, message, received_at)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.close_code = self.websocket.close_code
+            self.close_reason = self.websocket.close_reason
+            self._heartbeat_task.cancel()
+            if self.on_close is not None:
+                self.on_close(self)
+
+    async def wait_closed(self):
+        if self._read_task is not None:
+            await self._read_task
+
+    async def close(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        if self.websocket is not None:
+            await self.websocket.close()
+        await self.wait_closed()
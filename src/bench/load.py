@@ -0,0 +1,189 @@
+"""Load test the gateway with many concurrent clients.
+
+Start the api with `python -m bench.serve --dataset bench-dataset.json`,
+then from another shell run `python -m bench.load --dataset
+bench-dataset.json --clients 5000`. Clients connect at `--connect-rate`,
+identify and keep heartbeating at the interval from hello while messages
+are posted at `--message-rate` for `--duration` seconds.
+
+It reports the time to READY, the latency from starting a message POST to
+each member's socket receiving it, and connections the server closed
+grouped by close code, as JSON.
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+from collections import Counter
+from time import perf_counter
+from aiohttp import ClientSession, TCPConnector
+from .gateway import GatewayClient
+from .report import Measurement, write_results
+from .seed import Dataset
+from .standins import auth_headers, token_for
+
+
+def raise_file_limit():
+    """Every socket is a file descriptor, allow as many as the hard limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class LoadTest:
+    """One load test run, calling it returns the connect, message create and
+    delivery results"""
+
+    def __init__(self, dataset, api_url, ws_url, clients=1000, connect_rate=200,
+                 connect_concurrency=200, message_rate=10, duration=60, rng=None):
+        self.dataset = dataset
+        self.api_url = api_url
+        self.ws_url = ws_url
+        self.clients = clients
+        self.connect_rate = connect_rate
+        self.connect_concurrency = connect_concurrency
+        self.message_rate = message_rate
+        self.duration = duration
+        self.rng = rng or random.Random(0)
+        self.connect = Measurement('connect')
+        self.post = Measurement('message_create')
+        self.delivery = Measurement('delivery')
+        self.dropped = Counter()
+        self.connect_failures = Counter()
+        # message content -> when its POST started
+        self.sent = {}
+        # board uid -> connected clients of its members
+        self.online = Counter()
+        self.expected = 0
+        self.connected = []
+        # client -> uids of the boards its user is a member of
+        self._boards = {}
+        self._closing = False
+
+    def _on_dispatch(self, client, message, received_at):
+        if message.get('t') != 'MESSAGE_CREATE':
+            return
+        started = self.sent.get(message['d'].get('content'))
+        if started is not None:
+            self.delivery.latencies.append(received_at - started)
+
+    def _on_close(self, client):
+        if not self._closing:
+            self.dropped[str(client.close_code)] += 1
+            for board_uid in self._boards[client]:
+                self.online[board_uid] -= 1
+
+    async def _connect(self, user_uid, limit):
+        client = GatewayClient(
+            self.ws_url, token_for(user_uid), self._on_dispatch, on_close=self._on_close)
+        self._boards[client] = [b.uid for b in self.dataset.boards if user_uid in b.member_uids]
+        async with limit:
+            try:
+                elapsed = await client.connect()
+            except Exception as e:
+                self.connect.errors += 1
+                self.connect_failures[str(client.close_code or type(e).__name__)] += 1
+                return
+        self.connect.latencies.append(elapsed)
+        self.connected.append(client)
+        for board_uid in self._boards[client]:
+            self.online[board_uid] += 1
+
+    async def ramp_up(self):
+        members = [uid for board in self.dataset.boards for uid in board.member_uids]
+        limit = asyncio.Semaphore(self.connect_concurrency)
+        start = perf_counter()
+        tasks = []
+        for i in range(self.clients):
+            # pace the connects instead of opening them all at once
+            delay = start + i / self.connect_rate - perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self._connect(members[i % len(members)], limit)))
+        await asyncio.gather(*tasks)
+        self.connect.elapsed = perf_counter() - start
+
+    async def _post(self, session, n):
+        board = self.rng.choice(self.dataset.boards)
+        content = f'load {n}'
+        self.expected += self.online[board.uid]
+        start = perf_counter()
+        self.sent[content] = start
+        try:
+            async with session.post(
+                    f'{self.api_url}/channels/{board.channel_uids[0]}/messages',
+                    headers=auth_headers(board.owner_uid), json={'content': content}) as resp:
+                resp.raise_for_status()
+        except Exception:
+            self.post.errors += 1
+        else:
+            self.post.latencies.append(perf_counter() - start)
+
+    async def send_messages(self):
+        tasks = []
+        async with ClientSession(connector=TCPConnector(limit=100)) as session:
+            start = perf_counter()
+            for n in range(int(self.duration * self.message_rate)):
+                delay = start + n / self.message_rate - perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(self._post(session, n)))
+            await asyncio.gather(*tasks)
+            self.post.elapsed = perf_counter() - start
+        # let the last deliveries arrive
+        await asyncio.sleep(1)
+        self.delivery.elapsed = perf_counter() - start
+        self.delivery.errors = max(0, self.expected - len(self.delivery.latencies))
+
+    async def __call__(self):
+        await self.ramp_up()
+        if self.message_rate > 0:
+            await self.send_messages()
+        else:
+            await asyncio.sleep(self.duration)
+        self._closing = True
+        still_open = sum(1 for c in self.connected if c.close_code is None)
+        await asyncio.gather(*(c.close() for c in self.connected), return_exceptions=True)
+        self.connect.extra = {
+            'connected': len(self.connected),
+            # sent to their shard's port by the shared one, see GatewayClient
+            'redirected': sum(c.redirects for c in self.connected),
+            'still_open': still_open,
+            'connect_failures': dict(self.connect_failures),
+            'dropped_by_close_code': dict(self.dropped)}
+        return [m.result() for m in (self.connect, self.post, self.delivery)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.load', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default='bench-dataset.json',
+                        help='written by python -m bench.serve')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--connect-rate', type=float, default=200, help='connects per second')
+    parser.add_argument('--connect-concurrency', type=int, default=200,
+                        help='handshakes in flight at once')
+    parser.add_argument('--message-rate', type=float, default=10, help='messages per second')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of messages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results here instead of stdout')
+    args = parser.parse_args()
+    limit = raise_file_limit()
+    if args.clients + 100 > limit:
+        parser.error(f'{args.clients} clients need more than the {limit} open files allowed')
+    with open(args.dataset) as f:
+        data = json.load(f)
+    test = LoadTest(Dataset.from_dict(data), data['api_url'], data['ws_url'],
+                    clients=args.clients, connect_rate=args.connect_rate,
+                    connect_concurrency=args.connect_concurrency,
+                    message_rate=args.message_rate, duration=args.duration,
+                    rng=random.Random(args.seed))
+    results = asyncio.run(test())
+    write_results(results, args.output, config={
+        k: v for k, v in vars(args).items() if k not in ('dataset', 'output')})
+
+if __name__ == '__main__':
+    main()
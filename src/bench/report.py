@@ -0,0 +1,125 @@
+"""Latency measurements and the results they are reported as"""
+import asyncio
+import json
+import threading
+from time import perf_counter
+from neomodel import db as neodb
+
+
+class RoundTripCounter:
+    """Counts the queries sent to the database.
+
+    neomodel sends everything, node methods included, through
+    `db.cypher_query`, `install` wraps it for the whole process.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._original = None
+
+    def install(self):
+        self._original = neodb.cypher_query
+
+        def cypher_query(*args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return self._original(*args, **kwargs)
+
+        neodb.cypher_query = cypher_query
+
+    def uninstall(self):
+        if self._original is not None:
+            neodb.cypher_query = self._original
+            self._original = None
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of `values`"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+class Measurement:
+    """Latencies of one scenario, in seconds"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0
+        self.round_trips = None
+        self.extra = {}
+
+    def result(self):
+        count = len(self.latencies)
+        requests = count + self.errors
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 3)
+
+        result = {
+            'scenario': self.name,
+            'requests': requests,
+            'errors': self.errors,
+            'p50_ms': ms(percentile(self.latencies, 0.5)),
+            'p99_ms': ms(percentile(self.latencies, 0.99)),
+            'max_ms': ms(max(self.latencies) if self.latencies else None),
+            'throughput_rps': round(count / self.elapsed, 2) if self.elapsed else None,
+            'db_round_trips_per_request':
+                round(self.round_trips / requests, 3)
+                if requests and self.round_trips is not None else None}
+        result.update(self.extra)
+        return result
+
+
+async def measure(name, requests, concurrency, func, counter=None):
+    """Call `await func(i)` for i in range(requests), at most `concurrency` at
+    a time, a call that raises counts as an error"""
+    measurement = Measurement(name)
+    indexes = iter(range(requests))
+
+    async def worker():
+        for i in indexes:
+            start = perf_counter()
+            try:
+                await func(i)
+            except Exception:
+                measurement.errors += 1
+            else:
+                measurement.latencies.append(perf_counter() - start)
+
+    before = counter.count if counter else 0
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    measurement.elapsed = perf_counter() - start
+    if counter is not None:
+        measurement.round_trips = counter.count - before
+    return measurement
+
+
+def write_results(results, path=None, **metadata):
+    """Write results as JSON to `path` or stdout"""
+    data = json.dumps(dict(metadata, results=results), indent=2)
+    if path is None:
+        print(data)
+    else:
+        with open(path, 'w') as f:
+            f.write(data + '\n')
+
+
+def compare(baseline, results):
+    """Print how p50, p99 and throughput moved against an earlier run"""
+    before = {r['scenario']: r for r in baseline['results']}
+    for result in results:
+        old = before.get(result['scenario'])
+        if old is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms', 'throughput_rps', 'db_round_trips_per_request'):
+            if old.get(key) and result.get(key) is not None:
+                changes.append(f'{key} {(result[key] - old[key]) / old[key]:+.1%}')
+        print(f'{result["scenario"]}: {", ".join(changes)}')
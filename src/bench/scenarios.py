@@ -0,0 +1,149 @@
+"""The benchmarked scenarios, each returns a list of Measurements"""
+import asyncio
+from collections import Counter
+from time import perf_counter
+from .gateway import GatewayClient
+from .report import Measurement, measure
+from .standins import auth_headers, token_for
+
+
+class Bench:
+    """Everything a scenario needs: the api's urls, an http session, the
+    seeded dataset and the knobs from the command line"""
+
+    def __init__(self, session, api_url, ws_url, dataset, counter, rng,
+                 requests=1000, concurrency=16, sockets=100, rounds=3):
+        self.session = session
+        self.api_url = api_url
+        self.ws_url = ws_url
+        self.dataset = dataset
+        self.counter = counter
+        self.rng = rng
+        self.requests = requests
+        self.concurrency = concurrency
+        self.sockets = sockets
+        self.rounds = rounds
+
+    async def request(self, method, path, user_uid, **kwargs):
+        async with self.session.request(
+                method, self.api_url + path, headers=auth_headers(user_uid), **kwargs) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    def random_board(self):
+        return self.rng.choice(self.dataset.boards)
+
+    async def connect(self, user_uids, on_dispatch=None):
+        """Connect one gateway client per user, returns (client, seconds to
+        READY) pairs with the exception instead for clients that failed"""
+        clients = [GatewayClient(self.ws_url, token_for(uid), on_dispatch) for uid in user_uids]
+        results = await asyncio.gather(*(c.connect() for c in clients), return_exceptions=True)
+        return [(c, r) for c, r in zip(clients, results)]
+
+
+async def board_fetch(bench):
+    async def call(i):
+        board = bench.random_board()
+        await bench.request('GET', f'/boards/{board.uid}', bench.rng.choice(board.member_uids))
+    return [await measure('board_fetch', bench.requests, bench.concurrency, call, bench.counter)]
+
+
+async def channel_list(bench):
+    async def call(i):
+        board = bench.random_board()
+        await bench.request(
+            'GET', f'/board/{board.uid}/channels', bench.rng.choice(board.member_uids))
+    return [await measure('channel_list', bench.requests, bench.concurrency, call, bench.counter)]
+
+
+async def scrollback(bench, limit=50):
+    """Pages of history before a random message, like a client scrolling up"""
+    async def call(i):
+        board = bench.random_board()
+        channel_uid = bench.rng.choice(board.channel_uids)
+        history = bench.dataset.messages[channel_uid]
+        params = {'limit': str(limit)}
+        if history:
+            params['before'] = str(bench.rng.choice(history))
+        await bench.request(
+            'GET', f'/channels/{channel_uid}/messages', bench.rng.choice(board.member_uids),
+            params=params)
+    return [await measure('scrollback', bench.requests, bench.concurrency, call, bench.counter)]
+
+
+async def message_create_fanout(bench, timeout=10):
+    """Messages posted to a board with `sockets` of its members connected,
+    reports how long the POST took and how long until each socket got the
+    message"""
+    board = max(bench.dataset.boards, key=lambda b: len(b.member_uids))
+    user_uids = [board.member_uids[i % len(board.member_uids)] for i in range(bench.sockets)]
+    sent = {}
+    delivery = Measurement('message_create_fanout.delivery')
+    expected = bench.requests * bench.sockets
+    everything = asyncio.Event()
+
+    def on_dispatch(client, message, received_at):
+        if message.get('t') != 'MESSAGE_CREATE':
+            return
+        started = sent.get(message['d'].get('content'))
+        if started is not None:
+            delivery.latencies.append(received_at - started)
+            if len(delivery.latencies) >= expected:
+                everything.set()
+
+    connected = await bench.connect(user_uids, on_dispatch)
+    clients = [c for c, r in connected if not isinstance(r, Exception)]
+    channel_uid = board.channel_uids[0]
+
+    async def call(i):
+        content = f'fanout {i}'
+        sent[content] = perf_counter()
+        await bench.request(
+            'POST', f'/channels/{channel_uid}/messages', board.owner_uid,
+            json={'content': content})
+
+    start = perf_counter()
+    post = await measure('message_create', bench.requests, bench.concurrency, call, bench.counter)
+    try:
+        await asyncio.wait_for(everything.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    delivery.elapsed = perf_counter() - start
+    delivery.errors = expected - len(delivery.latencies)
+    delivery.extra = {'sockets': len(clients), 'failed_connects': len(connected) - len(clients)}
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    return [post, delivery]
+
+
+async def reconnect_storm(bench):
+    """`sockets` clients identifying at the same time, `rounds` times over,
+    reports the time to READY"""
+    measurement = Measurement('reconnect_storm')
+    close_codes = Counter()
+    user_uids = [bench.rng.choice(bench.dataset.user_uids) for _ in range(bench.sockets)]
+    before = bench.counter.count
+    start = perf_counter()
+    for _ in range(bench.rounds):
+        connected = await bench.connect(user_uids)
+        for client, result in connected:
+            if isinstance(result, Exception):
+                measurement.errors += 1
+                close_codes[str(client.close_code)] += 1
+            else:
+                measurement.latencies.append(result)
+        await asyncio.gather(
+            *(c.close() for c, r in connected if not isinstance(r, Exception)),
+            return_exceptions=True)
+    measurement.elapsed = perf_counter() - start
+    measurement.round_trips = bench.counter.count - before
+    measurement.extra = {'sockets': bench.sockets, 'close_codes': dict(close_codes)}
+    return [measurement]
+
+
+SCENARIOS = {
+    'board_fetch': board_fetch,
+    'channel_list': channel_list,
+    'scrollback': scrollback,
+    'message_create_fanout': message_create_fanout,
+    'reconnect_storm': reconnect_storm,
+}
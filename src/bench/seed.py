@@ -0,0 +1,112 @@
+"""Fills a scratch database with users, boards, channels and messages"""
+import random
+from neomodel import db as neodb
+from snowflake import LocalSnowflakeGenerator
+from templates import CREATE_BOARD_QUERY, DEFAULT_BOARD, BoardTemplate
+from migrations import MESSAGE_CHANNEL_INDEX_QUERY
+from messages import CREATE_MESSAGES_QUERY
+
+WIPE_QUERY = 'MATCH (n) DETACH DELETE n'
+
+USERS_QUERY = '''
+UNWIND $users AS user
+CREATE (:User {uid: user.uid, username: user.username, discriminator: user.discriminator,
+               hashp: 'bench'})
+'''
+
+MEMBERS_QUERY = '''
+UNWIND $members AS member
+MATCH (u:User {uid: member.user_uid})
+MATCH (b:Board {uid: member.board_uid})
+CREATE (u)-[:SUBSCRIBED_TO {role: member.role_uid}]->(b)
+'''
+
+class BoardData:
+    __slots__ = ('uid', 'owner_uid', 'member_uids', 'channel_uids')
+
+    def __init__(self, uid, owner_uid, member_uids, channel_uids):
+        self.uid = uid
+        self.owner_uid = owner_uid
+        self.member_uids = member_uids
+        self.channel_uids = channel_uids
+
+    def to_dict(self):
+        return {'uid': self.uid, 'owner_uid': self.owner_uid,
+                'member_uids': self.member_uids, 'channel_uids': self.channel_uids}
+
+
+class Dataset:
+    """What `seed` created, every board's first member is its owner"""
+    __slots__ = ('user_uids', 'boards', 'messages')
+
+    def __init__(self, user_uids, boards, messages):
+        self.user_uids = user_uids
+        self.boards = boards
+        # channel uid -> uids of its messages, oldest first
+        self.messages = messages
+
+    def to_dict(self):
+        return {'user_uids': self.user_uids,
+                'boards': [board.to_dict() for board in self.boards],
+                'messages': {str(k): v for k, v in self.messages.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['user_uids'], [BoardData(**board) for board in data['boards']],
+                   {int(k): v for k, v in data['messages'].items()})
+
+
+def _batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def seed(users=100, boards=10, members=20, channels=5, messages=200,
+               batch_size=1000, rng=None):
+    """Wipe the database and create `users` users and `boards` boards, each
+    with `members` members, `channels` channels and `messages` messages
+    in every channel"""
+    rng = rng or random.Random(0)
+    generator = LocalSnowflakeGenerator(worker_id=2)
+
+    async def snowflake():
+        return generator()
+
+    neodb.cypher_query(WIPE_QUERY)
+    neodb.install_all_labels()
+    neodb.cypher_query(MESSAGE_CHANNEL_INDEX_QUERY)
+
+    user_uids = [generator() for _ in range(users)]
+    for batch in _batches(user_uids, batch_size):
+        neodb.cypher_query(USERS_QUERY, {'users': [
+            {'uid': uid, 'username': f'bench{uid}', 'discriminator': f'{uid % 10000:04}'}
+            for uid in batch]})
+
+    template = BoardTemplate(DEFAULT_BOARD.roles, [
+        {'name': f'channel-{i}', 'type': 0, 'topic': 'benchmarks', 'position': i}
+        for i in range(channels)])
+    everyone = next(r['name'] for r in template.roles if r['name'] != template.owner_role)
+    created = []
+    for i in range(boards):
+        board_members = rng.sample(user_uids, min(members, len(user_uids)))
+        params = await template.params(snowflake, f'bench board {i}', board_members[0])
+        neodb.cypher_query(CREATE_BOARD_QUERY, params)
+        role_uid = next(r['uid'] for r in params['roles'] if r['name'] == everyone)
+        neodb.cypher_query(MEMBERS_QUERY, {'members': [
+            {'user_uid': uid, 'board_uid': params['uid'], 'role_uid': role_uid}
+            for uid in board_members[1:]]})
+        created.append(BoardData(
+            params['uid'], board_members[0], board_members,
+            [c['uid'] for c in params['channels']]))
+
+    history = {}
+    for board in created:
+        for channel_uid in board.channel_uids:
+            rows = [{'uid': generator(), 'channel_uid': channel_uid,
+                     'author_uid': rng.choice(board.member_uids),
+                     'content': f'bench message {n}'}
+                    for n in range(messages)]
+            for batch in _batches(rows, batch_size):
+                neodb.cypher_query(CREATE_MESSAGES_QUERY, {'messages': batch})
+            history[channel_uid] = [row['uid'] for row in rows]
+    return Dataset(user_uids, created, history)
@@ -0,0 +1,104 @@
+"""Serve the api on seeded data with local stand-ins, so load can be sent
+from another process. The dataset is written as JSON for the load
+generator, see `python -m bench.serve --help`."""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+from aiohttp import ClientSession, ClientError
+from neomodel import db as neodb
+from app import create_server
+from .seed import seed
+from .standins import SnowflakeStandIn, AuthStandIn
+
+
+def add_arguments(parser):
+    """The options for the database, the dataset and the api's ports"""
+    parser.add_argument('--db-url', default=os.environ.get('BENCH_DB_URL'),
+                        help='bolt url of a scratch Neo4j, it is wiped (default $BENCH_DB_URL)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--boards', type=int, default=20)
+    parser.add_argument('--members', type=int, default=50, help='members per board')
+    parser.add_argument('--channels', type=int, default=5, help='channels per board')
+    parser.add_argument('--messages', type=int, default=200, help='messages per channel')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--http-port', type=int, default=18080)
+    parser.add_argument('--ws-port', type=int, default=18000)
+
+
+class Api:
+    """The api with its stand-ins, running in this process"""
+
+    def __init__(self, dataset, server, server_task, standins, http_port, ws_port):
+        self.dataset = dataset
+        self.server = server
+        self.standins = standins
+        self.api_url = f'http://127.0.0.1:{http_port}'
+        self.ws_url = f'ws://127.0.0.1:{ws_port}/'
+        self._server_task = server_task
+
+    async def close(self):
+        await self.server.exit()
+        await self._server_task
+        for standin in self.standins:
+            await standin.close()
+
+
+async def wait_for_server(url, timeout=10):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    async with ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url):
+                    return
+            except ClientError:
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def start(args):
+    """Seed the database and start the stand-ins and the api"""
+    neodb.set_connection(args.db_url)
+    dataset = await seed(args.users, args.boards, args.members, args.channels, args.messages,
+                         rng=random.Random(args.seed))
+    snowflake = SnowflakeStandIn()
+    auth = AuthStandIn()
+    await snowflake.start()
+    await auth.start()
+    server = create_server(args.db_url, snowflake.url + '/', auth.url, host='127.0.0.1',
+                           port=args.http_port, ws_port=args.ws_port)
+    api = Api(dataset, server, asyncio.ensure_future(server()), [snowflake, auth],
+              args.http_port, args.ws_port)
+    await wait_for_server(api.api_url + '/')
+    return api
+
+
+async def serve(args):
+    api = await start(args)
+    with open(args.dataset, 'w') as f:
+        json.dump(dict(api.dataset.to_dict(), api_url=api.api_url, ws_url=api.ws_url), f)
+    print(f'serving on {api.api_url} and {api.ws_url}, dataset in {args.dataset}', flush=True)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await api.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench.serve', description=__doc__)
+    add_arguments(parser)
+    parser.add_argument('--dataset', default='bench-dataset.json',
+                        help='where to write the dataset')
+    args = parser.parse_args()
+    if not args.db_url:
+        parser.error('--db-url or BENCH_DB_URL is required')
+    asyncio.run(serve(args))
+
+if __name__ == '__main__':
+    main()
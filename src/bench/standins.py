@@ -0,0 +1,94 @@
+"""Local stand-ins for the snowflake and auth hosts"""
+from aiohttp import web
+from snowflake import LocalSnowflakeGenerator
+
+TOKEN_PREFIX = 'bench-'
+
+
+def token_for(uid):
+    """The token the auth stand-in accepts for a user"""
+    return f'{TOKEN_PREFIX}{uid}'
+
+
+def auth_headers(uid):
+    # roamrs reads the user from a misspelt header, send both
+    token = token_for(uid)
+    return {'Authorization': token, 'Authorizaiton': token}
+
+
+class StandIn:
+    """A small aiohttp app listening on a local port, 0 picks a free one"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._runner = None
+
+    def routes(self):
+        return []
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    @web.middleware
+    async def _count(self, request, handler):
+        self.requests += 1
+        return await handler(request)
+
+    async def start(self):
+        app = web.Application(middlewares=[self._count])
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class SnowflakeStandIn(StandIn):
+    """Hands out snowflakes like the snowflake host, as worker 1"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.generator = LocalSnowflakeGenerator(worker_id=1)
+
+    def routes(self):
+        return [web.get('/', self.snowflake)]
+
+    async def snowflake(self, request):
+        return web.json_response({'snowflake': str(self.generator())})
+
+
+class AuthStandIn(StandIn):
+    """Accepts `token_for(uid)` as the token of the user with that uid"""
+
+    def routes(self):
+        return [web.get('/verify', self.verify), web.get('/get_user', self.get_user)]
+
+    @staticmethod
+    def _uid(request):
+        token = request.headers.get('Authorization', '')
+        if not token.startswith(TOKEN_PREFIX):
+            return None
+        try:
+            return int(token[len(TOKEN_PREFIX):])
+        except ValueError:
+            return None
+
+    async def verify(self, request):
+        if self._uid(request) is None:
+            raise web.HTTPUnauthorized()
+        return web.json_response({})
+
+    async def get_user(self, request):
+        uid = self._uid(request)
+        if uid is None:
+            raise web.HTTPUnauthorized()
+        return web.json_response({'uid': uid})
@@ -1,42 +1,51 @@
 """Run the rest server"""
 from time import sleep
 import asyncio
+import logging
 import os
+import signal
 
 from neomodel import db as neodb
 import neo4j
-from roamrs import HTTPServer, Method
-from ws import WebSocketExtension
 
-from utils import SnowflakeService, BoardDeleteService
-from user import UserCog
-from board import BoardCog
-from channel import ChannelCog
+from app import create_server
+from supervisor import Supervisor
 
 def main():
     """Run the servur"""
     env = os.environ
+    logging.basicConfig(
+        level=env.get('LOG_LEVEL', 'WARNING').upper(),
+        format='%(asctime)s %(levelname)s %(name)s[%(process)d] %(message)s')
+    workers = int(env.get('WORKERS', 1))
+    if workers > 1 and 'WORKER_INDEX' not in env:
+        # this is the supervisor, the workers run this again with their index
+        supervisor = Supervisor(workers, env.get('EVENT_BUS_PATH', '/tmp/roam-bus.sock'))
+        asyncio.get_event_loop().run_until_complete(supervisor())
+        return
+    db_url = f'bolt://{env["DB_USER"]}:{env["DB_PASS"]}@{env["DB_HOST"]}:7687'
     while True:
         try:
-            neodb.set_connection(f'bolt://{env["DB_USER"]}:{env["DB_PASS"]}@{env["DB_HOST"]}:7687')
+            neodb.set_connection(db_url)
         except neo4j.exceptions.ServiceUnavailable:
             sleep(1)
         else:
             break
     loop = asyncio.get_event_loop()
-    snow = SnowflakeService.service_factory(f'http://{env["SNOW_HOST"]}:8080/')
-    boardds = BoardDeleteService.service_factory()
-    websocket = WebSocketExtension('0.0.0.0', 8000)
-    server = HTTPServer(
-        {'snowflake': snow, 'board_delete': boardds},
-        {'ws': websocket},
-        port=80,
-        security_url=f'http://{env["AUTH_HOST"]}')
-    cogs = [UserCog(), BoardCog(), ChannelCog()]
-
-    for cog in cogs:
-        server.load_cog(cog)
+    shard = int(env.get('WORKER_INDEX', 0))
+    metrics_port = env.get('METRICS_PORT', '9100')
+    server = create_server(
+        db_url,
+        f'http://{env["SNOW_HOST"]}:8080/',
+        f'http://{env["AUTH_HOST"]}',
+        pool_size=int(env.get('DB_POOL_SIZE', 8)),
+        bus_path=env.get('EVENT_BUS_PATH'),
+        shard=shard,
+        workers=workers,
+        # every worker serves its own metrics, set METRICS_PORT empty to disable
+        metrics_port=int(metrics_port) + shard if metrics_port else None)
 
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(server.exit()))
     loop.run_until_complete(server())
     loop.close()
 
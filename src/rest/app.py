@@ -0,0 +1,59 @@
+"""Assembles the api server from its services, extensions and cogs"""
+from ws import WebSocketExtension
+from utils import SnowflakeService, BoardDeleteService, TokenUserService
+from dal import DatabaseService
+from permissions import PermissionService
+from buffers import MessageBufferService
+from responses import ResponseCacheService
+from messages import MessageWriteService
+from bus import LocalEventBus, UnixEventBus
+from supervisor import WorkerServer
+from metrics import MetricsExtension, TimedTokenValidator, instrument_queries, timed_route
+from user import UserCog
+from board import BoardCog
+from channel import ChannelCog
+
+
+def create_server(db_url, snow_url, auth_url, host='0.0.0.0', port=80, ws_port=8000,
+                  pool_size=8, bus_path=None, shard=0, workers=1,
+                  metrics_port=None):
+    """Build the server a worker runs, `bus_path` is the socket of the
+    EventHub shared with the other workers if there are any. Metrics are
+    served on localhost:`metrics_port` when it is set"""
+    instrument_queries()
+    # workers share a host, their index keeps local snowflakes apart
+    snow = SnowflakeService.service_factory(snow_url, process_id=shard)
+    boardds = BoardDeleteService.service_factory()
+    dbs = DatabaseService.service_factory(db_url, pool_size)
+    # invalidating permissions doesn't reach the other workers
+    perms = PermissionService.service_factory(ttl=60 if workers == 1 else 5)
+    users = TokenUserService.service_factory()
+    message_buffer = MessageBufferService.service_factory()
+    responses = ResponseCacheService.service_factory()
+    message_writer = MessageWriteService.service_factory()
+    if bus_path:
+        # events go through an EventHub shared with the other workers
+        bus = UnixEventBus.service_factory(bus_path)
+    else:
+        bus = LocalEventBus.service_factory()
+    websocket = WebSocketExtension(host, ws_port, shard=shard, shard_count=workers)
+    extensions = {'ws': websocket}
+    if metrics_port is not None:
+        extensions['metrics'] = MetricsExtension(port=metrics_port)
+    server = WorkerServer(
+        {'snowflake': snow, 'board_delete': boardds, 'db': dbs,
+         'permissions': perms, 'users': users,
+         'message_buffer': message_buffer, 'message_writer': message_writer,
+         'responses': responses, 'bus': bus,
+         'roamgg_token': TimedTokenValidator.service_factory(auth_url)},
+        extensions,
+        host=host,
+        port=port,
+        reuse_port=workers > 1)
+    # buffered channels hear about messages sent through the other workers
+    server.services['message_buffer'].follow(server.services['bus'])
+    for cog in (UserCog(), BoardCog(), ChannelCog()):
+        for route in cog._routes:
+            route.func = timed_route(route.method, route.path, route.func)
+        server.load_cog(cog)
+    return server
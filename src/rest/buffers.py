@@ -0,0 +1,195 @@
+"""Recent messages of busy channels, kept encoded in memory"""
+import json
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from time import monotonic
+from roamrs import Service
+from utils import EventType
+
+
+class ChannelBuffer:
+    """The newest messages of a channel, oldest first.
+
+    Once seeded the buffer holds every message of the channel from its
+    oldest entry onwards, `complete` means that is the channel's whole
+    history. Messages appended before the first read are kept but the buffer
+    can't answer anything until it has been seeded from the database.
+    """
+    __slots__ = ('uids', 'frames', 'maxlen', 'size', 'seeded', 'seeded_at', 'complete',
+                 'board_uid')
+
+    def __init__(self, maxlen, board_uid=None):
+        self.uids = []
+        self.frames = []
+        self.maxlen = maxlen
+        self.size = 0
+        self.seeded = False
+        self.seeded_at = None
+        self.complete = False
+        self.board_uid = board_uid
+
+    def clear(self):
+        self.uids.clear()
+        self.frames.clear()
+        self.size = 0
+        self.seeded = False
+        self.complete = False
+
+    def add(self, uid, frame):
+        index = bisect_left(self.uids, uid)
+        if index < len(self.uids) and self.uids[index] == uid:
+            return
+        self.uids.insert(index, uid)
+        self.frames.insert(index, frame)
+        self.size += len(frame)
+        while len(self.uids) > self.maxlen:
+            del self.uids[0]
+            self.size -= len(self.frames.pop(0))
+            self.complete = False
+
+    def before(self, uid, limit):
+        """The `limit` newest messages older than `uid`, None if the database
+        might have some the buffer doesn't"""
+        end = len(self.uids) if uid is None else bisect_left(self.uids, uid)
+        if end < limit and not self.complete:
+            return None
+        return self.frames[max(0, end - limit):end]
+
+    def after(self, uid, limit):
+        """The `limit` oldest messages newer than `uid`, None if the database
+        might have some the buffer doesn't"""
+        if not self.complete and (not self.uids or uid < self.uids[0]):
+            return None
+        start = bisect_right(self.uids, uid)
+        return self.frames[start:start + limit]
+
+
+class MessageBufferService(Service):
+    """Keeps the newest `per_channel` messages of recently used channels as
+    encoded JSON, channels are evicted least recently used first once the
+    buffers hold more than `max_bytes` of messages.
+
+    Once `follow` is given the event bus the buffers subscribe to the boards
+    of their channels, so messages sent through other workers are added and
+    channels deleted through them are dropped, as are the channels of boards
+    a member of was renamed. A buffer is seeded again after
+    `max_age` seconds in case the bus lost an event.
+    """
+    __slots__ = ('per_channel', 'max_bytes', 'max_age', 'size', 'hits', 'misses', 'bus',
+                 '_buffers', '_boards')
+
+    def __init__(self, *args, per_channel=100, max_bytes=64*1024*1024, max_age=5*60,
+                 **kwargs):
+        self.per_channel = per_channel
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bus = None
+        self._buffers = OrderedDict()
+        # board uid -> uids of its channels that have a buffer
+        self._boards = {}
+
+    def follow(self, bus):
+        self.bus = bus
+        bus.listen(self._deliver)
+        bus.subscribe(board_uids=list(self._boards))
+
+    def _fresh(self, buffer):
+        return buffer.seeded and monotonic() - buffer.seeded_at < self.max_age
+
+    def __call__(self, channel_uid, limit, before=None, after=None, around=None):
+        """Return a page of messages as a JSON array in the same format as
+        messages.message_history, or None if the buffer doesn't cover it"""
+        buffer = self._buffers.get(channel_uid)
+        frames = None
+        if buffer is not None and self._fresh(buffer):
+            self._buffers.move_to_end(channel_uid)
+            if around is not None:
+                older = buffer.before(around, limit // 2)
+                newer = buffer.after(around, limit // 2)
+                if older is not None and newer is not None:
+                    frames = older + newer
+            elif after is not None:
+                frames = buffer.after(after, limit)
+            else:
+                frames = buffer.before(before, limit)
+        if frames is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return '[' + ', '.join(frames) + ']'
+
+    def _buffer(self, channel_uid, board_uid):
+        buffer = self._buffers.get(channel_uid)
+        if buffer is not None:
+            self._buffers.move_to_end(channel_uid)
+            return buffer
+        buffer = self._buffers[channel_uid] = ChannelBuffer(self.per_channel, board_uid)
+        channels = self._boards.get(board_uid)
+        if channels is None:
+            channels = self._boards[board_uid] = set()
+            if self.bus is not None:
+                self.bus.subscribe(board_uids=[board_uid])
+        channels.add(channel_uid)
+        return buffer
+
+    def _drop(self, channel_uid):
+        buffer = self._buffers.pop(channel_uid)
+        self.size -= buffer.size
+        channels = self._boards[buffer.board_uid]
+        channels.discard(channel_uid)
+        if not channels:
+            del self._boards[buffer.board_uid]
+            if self.bus is not None:
+                self.bus.unsubscribe(board_uids=[buffer.board_uid])
+
+    def _add(self, buffer, messages):
+        self.size -= buffer.size
+        for message in messages:
+            buffer.add(message['uid'], json.dumps(message))
+        self.size += buffer.size
+        while self.size > self.max_bytes and len(self._buffers) > 1:
+            self._drop(next(iter(self._buffers)))
+
+    def append(self, channel_uid, message):
+        """Add a newly created message to its channel's buffer, channels
+        only get one once they are read"""
+        buffer = self._buffers.get(channel_uid)
+        if buffer is not None:
+            self._add(buffer, [message])
+
+    def watch(self, channel_uid, board_uid):
+        """Start collecting a channel's new messages, call before reading the
+        page `seed` is given so messages sent meanwhile aren't missed"""
+        buffer = self._buffer(channel_uid, board_uid)
+        if buffer.seeded and not self._fresh(buffer):
+            self.size -= buffer.size
+            buffer.clear()
+
+    def seed(self, channel_uid, board_uid, messages, complete):
+        """Fill a channel's buffer with its newest page from the database,
+        `complete` if that page is the whole channel"""
+        buffer = self._buffer(channel_uid, board_uid)
+        buffer.seeded = True
+        buffer.seeded_at = monotonic()
+        buffer.complete = complete
+        self._add(buffer, messages)
+
+    def forget(self, channel_uid):
+        if channel_uid in self._buffers:
+            self._drop(channel_uid)
+
+    async def _deliver(self, event, board_uid, payload, user_uids):
+        if event is EventType.MESSAGE_CREATE:
+            buffer = self._buffers.get(payload['channel_uid'])
+            if buffer is not None:
+                self._add(buffer, [payload])
+        elif event is EventType.CHANNEL_DELETE:
+            self.forget(payload['uid'])
+        elif event is EventType.BOARD_DELETE or event is EventType.USER_UPDATE:
+            # frames have their author's name in them, renames are rare
+            # enough to just read the board's channels again
+            for channel_uid in list(self._boards.get(board_uid, ())):
+                self._drop(channel_uid)
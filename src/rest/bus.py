@@ -0,0 +1,296 @@
+"""Carries gateway events between the processes serving the api.
+
+Events are published with the uid of the board they are about and a payload
+that is already serialized, listeners only get the events of boards and
+users they subscribed to.
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+from roamrs import Service
+from utils import EventType
+
+log = logging.getLogger(__name__)
+
+# the longest line the hub and its clients read, payloads of big boards and
+# messages are well past asyncio's default of 64 KiB
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# the hub disconnects a client that has this much waiting to be sent to it,
+# it reconnects and subscribes again once it has caught up
+MAX_BUFFERED = 2 * MAX_MESSAGE_SIZE
+
+
+class LocalEventBus(Service):
+    """Delivers events to listeners in the same process.
+
+    Everything published goes to every listener, the gateway already keeps
+    track of which boards its connections are in.
+    """
+    __slots__ = ('_listeners',)
+
+    def __init__(self, *args, **kwargs):
+        self._listeners = []
+
+    def listen(self, callback):
+        """Call `await callback(event, board_uid, payload, user_uids)` for
+        every event of a subscribed board or user"""
+        self._listeners.append(callback)
+
+    def subscribe(self, board_uids=(), user_uids=()):
+        pass
+
+    def unsubscribe(self, board_uids=(), user_uids=()):
+        pass
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def publish(self, event, board_uid, payload, user_uids=None):
+        """Publish an event about a board, `user_uids` are users that should
+        get it even if they aren't subscribed to the board yet"""
+        await self._notify(event, board_uid, payload, user_uids)
+
+    async def _notify(self, event, board_uid, payload, user_uids):
+        # a failing listener doesn't keep the event from the others
+        for callback in self._listeners:
+            try:
+                await callback(event, board_uid, payload, user_uids)
+            except Exception:
+                log.exception('event listener failed on %s of board %s', event.value, board_uid)
+
+
+def _encode(message):
+    return json.dumps(message).encode() + b'\n'
+
+
+class UnixEventBus(LocalEventBus):
+    """Delivers events through an EventHub listening on a Unix socket, so
+    REST workers and gateway shards can run in their own processes.
+
+    Subscriptions are kept here and sent again whenever the connection to
+    the hub is made, events published while it is down are lost.
+    """
+    __slots__ = ('path', 'reconnect_delay', '_boards', '_users', '_writer', '_connected',
+                 '_task')
+
+    def __init__(self, path, *args, reconnect_delay=1, **kwargs):
+        super().__init__()
+        self.path = path
+        self.reconnect_delay = reconnect_delay
+        # uid -> number of subscribe calls not yet undone
+        self._boards = {}
+        self._users = {}
+        self._writer = None
+        self._connected = None
+        self._task = None
+
+    def _send(self, message):
+        if self._writer is not None:
+            self._writer.write(_encode(message))
+
+    def _count(self, counts, uids, step):
+        changed = []
+        for uid in uids:
+            count = counts.get(uid, 0) + step
+            if count > 0:
+                counts[uid] = count
+            else:
+                counts.pop(uid, None)
+            if count == (1 if step > 0 else 0):
+                changed.append(uid)
+        return changed
+
+    def subscribe(self, board_uids=(), user_uids=()):
+        boards = self._count(self._boards, board_uids, 1)
+        users = self._count(self._users, user_uids, 1)
+        if boards or users:
+            self._send({'t': 'sub', 'b': boards, 'u': users})
+
+    def unsubscribe(self, board_uids=(), user_uids=()):
+        boards = self._count(self._boards, board_uids, -1)
+        users = self._count(self._users, user_uids, -1)
+        if boards or users:
+            self._send({'t': 'unsub', 'b': boards, 'u': users})
+
+    async def start(self):
+        if self._task is None:
+            self._connected = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        await self._connected.wait()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def publish(self, event, board_uid, payload, user_uids=None):
+        if self._task is None:
+            await self.start()
+        writer = self._writer
+        if writer is None:
+            log.warning('not connected to the event hub, dropped %s of board %s',
+                        event.value, board_uid)
+            return
+        self._send({'t': 'pub', 'e': event.value, 'b': board_uid, 'u': user_uids, 'd': payload})
+        try:
+            await writer.drain()
+        except OSError:
+            log.warning('lost the event hub while publishing %s of board %s',
+                        event.value, board_uid)
+
+    async def _deliver(self, line):
+        try:
+            message = json.loads(line)
+            args = EventType(message['e']), message['b'], message['d'], message['u']
+        except (ValueError, KeyError, TypeError):
+            log.error('dropped an event the hub sent that could not be read')
+            return
+        await self._notify(*args)
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.path, limit=MAX_MESSAGE_SIZE)
+            except OSError:
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            self._writer = writer
+            self._send({'t': 'sub', 'b': list(self._boards), 'u': list(self._users)})
+            self._connected.set()
+            try:
+                while True:
+                    try:
+                        line = await reader.readline()
+                    except ValueError:
+                        log.error('dropped an event longer than %d bytes', MAX_MESSAGE_SIZE)
+                        continue
+                    if not line:
+                        break
+                    await self._deliver(line)
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            except Exception:
+                log.exception('reading from the event hub failed')
+            finally:
+                self._connected.clear()
+                self._writer = None
+                writer.close()
+            log.warning('lost the event hub at %s, reconnecting', self.path)
+            await asyncio.sleep(self.reconnect_delay)
+
+
+class EventHub:
+    """Relays events between UnixEventBus clients, each event goes to every
+    client subscribed to its board or to one of its users, including the
+    one that published it"""
+
+    def __init__(self, path):
+        self.path = path
+        # uid -> writers of the clients subscribed to it
+        self.boards = {}
+        self.users = {}
+        self._clients = set()
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(
+            self._client, self.path, limit=MAX_MESSAGE_SIZE)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._clients):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @staticmethod
+    def _add(index, uids, writer):
+        for uid in uids:
+            index.setdefault(uid, set()).add(writer)
+
+    @staticmethod
+    def _remove(index, uids, writer):
+        for uid in uids:
+            clients = index.get(uid)
+            if clients is not None:
+                clients.discard(writer)
+                if not clients:
+                    del index[uid]
+
+    async def _client(self, reader, writer):
+        boards = set()
+        users = set()
+        self._clients.add(writer)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    log.error('dropped a message longer than %d bytes', MAX_MESSAGE_SIZE)
+                    continue
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                    kind = message['t']
+                except (ValueError, KeyError, TypeError):
+                    log.error('dropped a message that could not be read')
+                    continue
+                if kind == 'pub':
+                    targets = set(self.boards.get(message['b'], ()))
+                    for user_uid in message['u'] or ():
+                        targets.update(self.users.get(user_uid, ()))
+                    for target in targets:
+                        if target.transport.is_closing():
+                            continue
+                        target.write(line)
+                        if target.transport.get_write_buffer_size() > MAX_BUFFERED:
+                            log.warning('disconnecting an event bus client that fell behind')
+                            target.transport.abort()
+                elif kind == 'sub':
+                    boards.update(message['b'])
+                    users.update(message['u'])
+                    self._add(self.boards, message['b'], writer)
+                    self._add(self.users, message['u'], writer)
+                elif kind == 'unsub':
+                    boards.difference_update(message['b'])
+                    users.difference_update(message['u'])
+                    self._remove(self.boards, message['b'], writer)
+                    self._remove(self.users, message['u'], writer)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        except (ValueError, KeyError, TypeError):
+            log.exception('dropping an event bus client that sent a bad message')
+        finally:
+            self._clients.discard(writer)
+            self._remove(self.boards, boards, writer)
+            self._remove(self.users, users, writer)
+            writer.close()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f'usage: {sys.argv[0]} SOCKET_PATH')
+        sys.exit(1)
+    hub = EventHub(sys.argv[1])
+
+    async def run():
+        await hub.start()
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
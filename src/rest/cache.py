@@ -0,0 +1,80 @@
+"""Small in process caches"""
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+_MISSING = object()
+
+
+class LRUCache:
+    """A least recently used cache, entries also expire `ttl` seconds after
+    they were set if a ttl is given"""
+    __slots__ = ('maxsize', 'ttl', 'hits', 'misses', '_data')
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is not _MISSING:
+            expires, value = entry
+            if expires is None or expires > monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else monotonic() + ttl
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        return entry[1]
+
+    def discard_where(self, predicate):
+        """Remove every entry whose key matches `predicate`"""
+        for key in [k for k in self._data if predicate(k)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key so only one of them runs,
+    everyone else waits for its result"""
+    __slots__ = ('_calls',)
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def __call__(self, key, func, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # shielded so one caller going away doesn't cancel it for the rest
+        return await asyncio.shield(future)
@@ -1,147 +1,146 @@
 from aiohttp import web
+from neomodel import db as neodb
 from roamrs import Cog, Method, route
-from db import User, Board, Role, Channel, Message
+from db import Channel
 from utils import user_wrapper, jsonify, EventType
-import asyncio
+from permissions import Permissions, requires
+from projections import channel_payload, message_from_row
+from messages import message_history
+
+# only the fields a client can change are written, channel.save() would also
+# write back the last_message_uid it loaded over a newer one
+UPDATE_CHANNEL_QUERY = '''
+MATCH (c:Channel {uid: $uid})
+SET c.name = coalesce($name, c.name),
+    c.topic = coalesce($topic, c.topic),
+    c.position = coalesce($position, c.position)
+'''
 
 class ChannelCog(Cog):
     @route('/channels/{channel.id}', Method.GET)
     async def get_channel(self, ctx):
-        channel_uid = ctx.url_data.get('channel.id')
-        channel = Channel.nodes.first_or_none(uid=channel_uid)
-        if not channel:
+        db = ctx.services.get('db')
+        responses = ctx.services.get('responses')
+        try:
+            channel_uid = int(ctx.url_data.get('channel.id'))
+        except (TypeError, ValueError):
             raise web.HTTPBadRequest()
-        return ctx.respond(jsonify(channel))
+        board_uid = await ctx.services.get('permissions').board_of(db, channel_uid)
+        if board_uid is None:
+            raise web.HTTPBadRequest()
+        response = await responses(
+            ctx.raw_request, ('channel', channel_uid, responses.version('board', board_uid)),
+            db, channel_payload, channel_uid)
+        if response is None:
+            raise web.HTTPBadRequest()
+        return response
 
     @route('/channels/{channel.id}', Method.PATCH)
     @user_wrapper
+    @requires(Permissions.MANAGE_CHANNELS)
     async def mod_channel(self, ctx):
-        user = ctx.user
         ws = ctx.extensions.get('ws')
+        db = ctx.services.get('db')
         channel_uid = ctx.url_data.get('channel.id')
-        channel = Channel.nodes.first_or_none(uid=channel_uid)
+        channel = await db(Channel.nodes.first_or_none, uid=channel_uid)
         if not channel:
             raise web.HTTPBadRequest()
-        board = channel.board_parent.single()
-        role_uid = board.subscribers.relationship(user).role
-        role = Role.nodes.first(uid=role_uid)
-        if (role.permissions & 8 == 8) or (role.permissions & 16 == 16):
-            sent_data = ctx.sent_data
-            if sent_data.get('name'):
-                channel.name = sent_data.get('name')
-            if sent_data.get('topic'):
-                channel.topic = sent_data.get('topic')
-            if sent_data.get('position'):
-                channel.position = sent_data.get('position')
-            channel.save()
-            await ws.event(EventType.CHANNEL_UPDATE, board.subscribers, channel=channel)
-            return ctx.respond(jsonify(channel))
-        raise web.HTTPForbidden(reason='Permission MANAGE_CHANNELS not set')
+        sent_data = ctx.sent_data
+        try:
+            params = {
+                'uid': channel.uid,
+                'name': sent_data.get('name') or None,
+                'topic': sent_data.get('topic') or None,
+                'position': int(sent_data['position']) if sent_data.get('position') else None}
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest()
+        await db(neodb.cypher_query, UPDATE_CHANNEL_QUERY, params)
+        ctx.services.get('responses').bump('board', ctx.board_uid)
+        j = await db(jsonify, channel)
+        await ws.event(EventType.CHANNEL_UPDATE, ctx.board_uid, channel=channel, payload=j)
+        return ctx.respond(j)
 
     @route('/channels/{channel.id}', Method.DELETE)
     @user_wrapper
+    @requires(Permissions.MANAGE_CHANNELS)
     async def delete_channel(self, ctx):
-        user = ctx.user
         ws = ctx.extensions.get('ws')
-        channel = Channel.nodes.first_or_none(uid=kwargs['url_data'].get('channel.id'))
+        db = ctx.services.get('db')
+        channel = await db(Channel.nodes.first_or_none, uid=ctx.url_data.get('channel.id'))
         if not channel:
             raise web.HTTPBadRequest()
-        board = channel.board_parent.single()
-        role_uid = board.subscribers.relationship(user).role
-        role = Role.nodes.first_or_none(uid=role_uid)
-        if not role:
-            raise web.HTTPBadRequest()
-        if (role.permissions & 8 == 8) or (role.permissions & 16 == 16):
-            j = jsonify(channel)
-            channel.delete()
-            await ws.event(EventType.CHANNEL_DELETE, board.subscribers, channel=channel)
-            return ctx.respond(j)
-        raise web.HTTPForbidden(reason='Permission MANAGE_CHANNELS not set')
+        j = await db(jsonify, channel)
+        await db(channel.delete)
+        ctx.services.get('responses').bump('board', ctx.board_uid)
+        ctx.services.get('permissions').forget_channel(j['uid'])
+        ctx.services.get('message_buffer').forget(j['uid'])
+        await ws.event(EventType.CHANNEL_DELETE, ctx.board_uid, channel=channel, payload=j)
+        return ctx.respond(j)
 
     @route('/channels/{channel.id}/messages', Method.GET)
     @user_wrapper
-    async def get_messages(ctx):
-        user = ctx.user
-        channel = Channel.nodes.first_or_none(uid=ctx.url_data.get('channel.id'))
-        if not channel:
+    @requires(Permissions.VIEW_CHANNEL)
+    async def get_messages(self, ctx):
+        db = ctx.services.get('db')
+        if not ctx.permissions & Permissions.READ_MESSAGE_HISTORY:
+            return web.json_response([])
+        sent_data = ctx.sent_data
+        try:
+            cursors = {k: int(sent_data[k]) for k in ('around', 'before', 'after') if sent_data.get(k)}
+            limit = int(sent_data.get('limit') or 50)
+        except ValueError:
             raise web.HTTPBadRequest()
-        board = channel.board_parent.single()
-        role_uid = board.subscribers.relationship(user).role
-        role = Role.nodes.first_or_none(uid=role_uid)
-        if not role:
+        if len(cursors) > 1:
             raise web.HTTPBadRequest()
-        if (role.permissions & 8 == 8) or (role.permissions & 1024 == 1024):
-            if not ((role.permissions & 65536 == 65536) or (role.permissions & 8 == 8)):
-                return web.json_response([])
-            sent_data = ctx.sent_data
-            around = sent_data.get('around')
-            before = sent_data.get('before')
-            after = sent_data.get('after')
-            limit = int(sent_data.get('limit') or 50)
-            if not 0 <= limit <= 100:
-                raise web.HTTPBadRequest()
-            if around:
-                if before or after:
-                    raise web.HTTPBadRequest()
-                before_messages = channel.messages.filter(uid__lt=around).order_by('-uid')[:int(limit/2)]
-                after_messages = channel.messages.filter(uid__gt=around).order_by('uid')[:int(limit/2)]
-                messages = before_messages + after_messages
-            if before:
-                if around or after:
-                    raise web.HTTPBadRequest()
-                messages = channel.messages.filter(uid__lt=before).order_by('-uid')[:limit][::-1]
-            if after:
-                if around or before:
-                    raise web.HTTPBadRequest()
-                messages = channel.messages.filter(uid__gt=after).order_by('uid')[:limit]
-            return ctx.respond([jsonify(msg) for msg in messages], content_type='application/json')
+        if not 0 <= limit <= 100:
+            raise web.HTTPBadRequest()
+        channel_uid = int(ctx.url_data['channel.id'])
+        buffers = ctx.services.get('message_buffer')
+        body = buffers(channel_uid, limit, **cursors)
+        if body is not None:
+            return web.Response(text=body, content_type='application/json')
+        if not cursors:
+            buffers.watch(channel_uid, ctx.board_uid)
+        j = await db(message_history, channel_uid, ctx.board_uid, limit, **cursors)
+        if not cursors:
+            buffers.seed(channel_uid, ctx.board_uid, j, complete=len(j) < limit)
+        return ctx.respond(j)
 
-        @route('/channels/{channel.id}/messages/{message.id}')
-        @user_wrapper
-        async def get_message(self, ctx):
-            user = ctx.user
-            channel = Channel.nodes.first_or_none(uid=ctx.url_data.get('channel.id'))
-            if not channel:
-                raise web.HTTPBadRequest()
-            board = channel.board_parent.single()
-            role_uid = board.subscribers.relationship(user).role
-            role = Role.nodes.first_or_none(uid=role_uid)
-            if not role:
-                raise web.HTTPBadRequest()
-            if (role.permissions & 8 == 8) or (role.permissions & 65536 == 65536):
-                message_uid = ctx.url_data.get('message.id')
-                message = channel.messages.filter(uid__exact=message_uid).first_or_none()
-                if not message:
-                    raise web.HTTPBadRequest()
-                return ctx.respond(jsonify(message))
-            raise web.HTTPForbidden(reason='Permission READ_MESSAGE_HISTORY is not set')
+    @route('/channels/{channel.id}/messages/{message.id}', Method.GET)
+    @user_wrapper
+    @requires(Permissions.READ_MESSAGE_HISTORY)
+    async def get_message(self, ctx):
+        db = ctx.services.get('db')
+        channel = await db(Channel.nodes.first_or_none, uid=ctx.url_data.get('channel.id'))
+        if not channel:
+            raise web.HTTPBadRequest()
+        message_uid = ctx.url_data.get('message.id')
+        message = await db(lambda: channel.messages.filter(uid__exact=message_uid).first_or_none())
+        if not message:
+            raise web.HTTPBadRequest()
+        return ctx.respond(await db(jsonify, message))
 
-        @route('/channels/{channel.id}/messages', Method.POST)
-        @user_wrapper
-        async def create_message(self, ctx):
-            user = ctx.user
-            ws = ctx.extensions.get('ws')
-            snowflake = ctx.services.get('snowflake')
-            websocket = ctx.services.get('websocket')
-            try:
-                channel = Channel.nodes.first_or_none(uid=kwargs['url_data']['channel.id'])
-            except KeyError:
-                raise web.HTTPBadRequest()
-            if not channel:
-                raise web.HTTPBadRequest()
-            board = channel.board_parent.single()
-            role_uid = board.subscribers.relationship(user).role
-            role = Role.nodes.first_or_none(uid=role_uid)
-            if not role:
-                raise web.HTTPBadRequest()
-            if (role.permissions & 8 == 8) or (role.permissions & 2048 == 2048):
-                message_data = ctx.sent_data
-                content = message_data['content']
-            if content == '':
-                raise web.HTTPBadRequest()
-            new_message = Message(uid=await snowflake(), content=content)
-            new_message.save()
-            new_message.author.connect(user)
-            new_message.channel.connect(channel)
-            await ws.event(EventType.MESSAGE_CREATE, board.subscribers, message=new_message)
-            return ctx.respond(jsonify(new_message))
+    @route('/channels/{channel.id}/messages', Method.POST)
+    @user_wrapper
+    @requires(Permissions.SEND_MESSAGES)
+    async def create_message(self, ctx):
+        user = ctx.user
+        ws = ctx.extensions.get('ws')
+        db = ctx.services.get('db')
+        snowflake = ctx.services.get('snowflake')
+        channel_uid = int(ctx.url_data['channel.id'])
+        message_data = ctx.sent_data
+        content = message_data['content']
+        if content == '':
+            raise web.HTTPBadRequest()
+        uid = await snowflake()
+        # committed together with the other messages sent around the same time
+        if not await ctx.services.get('message_writer')(db, uid, channel_uid, user.uid, content):
+            raise web.HTTPBadRequest()
+        # the board and its channels show the last message uid
+        ctx.services.get('responses').bump('board', ctx.board_uid)
+        j = message_from_row((uid, channel_uid, ctx.board_uid, user.uid,
+                              user.username, user.discriminator, content))
+        ctx.services.get('message_buffer').append(channel_uid, j)
+        await ws.event(EventType.MESSAGE_CREATE, ctx.board_uid, payload=j)
+        return ctx.respond(j)
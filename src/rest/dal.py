@@ -0,0 +1,57 @@
+"""Runs blocking neomodel calls off the event loop"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from neomodel import db as neodb
+from roamrs import Service
+
+
+class DatabaseService(Service):
+    """Runs neomodel calls on a bounded thread pool.
+
+    The threads share neomodel's process wide driver, which has to be
+    connected to `url` with `neodb.set_connection` before the server starts.
+    Await the service with the function to run and its arguments,
+    `await db(Board.nodes.first_or_none, uid=uid)`. Calls run in a copy of
+    the caller's context so queries count towards its request.
+    """
+    __slots__ = ('url', 'pool_size', '_executor', '_pending')
+
+    def __init__(self, url, pool_size, *args, **kwargs):
+        self.url = url
+        self.pool_size = pool_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size,
+            thread_name_prefix='neomodel')
+        self._pending = 0
+
+    async def __call__(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        try:
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self._executor, partial(context.run, func, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    @property
+    def pending(self):
+        """Calls that have been submitted and haven't finished yet"""
+        return self._pending
+
+    @property
+    def queue_depth(self):
+        """Calls waiting for a free worker"""
+        return max(0, self._pending - self.pool_size)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def run_transaction(query, params=None):
+    """Run a statement in its own explicit transaction, for writes that touch
+    several nodes and have to happen all at once or not at all"""
+    with neodb.transaction:
+        return neodb.cypher_query(query, params)
@@ -49,6 +49,8 @@ class Bot(Client):
 class Message(StructuredNode):
     uid = IntegerProperty(unique_index=True, required=True)
     content = StringProperty(required=True)
+    # copied from the channel so history can use the (channel_uid, uid) index
+    channel_uid = IntegerProperty(required=False)
 
     channel = RelationshipTo('Channel', 'POSTED_TO', cardinality=One)
     author = RelationshipTo('User', 'SAID_BY', cardinality=One)
@@ -74,6 +76,7 @@ class Channel(StructuredNode):
     type = IntegerProperty(required=True)
     name = StringProperty(required=True)
     topic = StringProperty(required=False)
+    last_message_uid = IntegerProperty(required=False)
 
     board_parent = RelationshipTo('Board', 'CHANNEL_OF', cardinality=One)
     messages = RelationshipFrom('Message', 'POSTED_TO', cardinality=ZeroOrMore)
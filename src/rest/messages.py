@@ -0,0 +1,170 @@
+"""Queries for writing and reading channel messages"""
+import asyncio
+from collections import deque
+from time import monotonic
+from neomodel import db as neodb
+from roamrs import Service
+from dal import run_transaction
+from metrics import MESSAGE_BATCH_SIZE
+from projections import message_from_row
+
+# The channel is locked once per batch to move last_message_uid forward, the
+# uids of the messages written are returned so callers can tell which of
+# them lost their channel or author in the meantime
+CREATE_MESSAGES_QUERY = '''
+UNWIND $messages AS message
+MATCH (c:Channel {uid: message.channel_uid})
+MATCH (u:User {uid: message.author_uid})
+CREATE (m:Message {uid: message.uid, content: message.content,
+                   channel_uid: message.channel_uid})-[:POSTED_TO]->(c)
+CREATE (m)-[:SAID_BY]->(u)
+WITH c, collect(message.uid) AS uids, max(message.uid) AS last
+SET c.last_message_uid = CASE
+    WHEN c.last_message_uid IS NULL OR c.last_message_uid < last THEN last
+    ELSE c.last_message_uid END
+RETURN uids
+'''
+
+# Every history page is a keyset lookup on the (channel_uid, uid) index so it
+# only ever touches `limit` messages no matter how long the channel is
+PAGE_QUERY = '''
+MATCH (m:Message) WHERE m.channel_uid = $channel_uid {condition}
+WITH m ORDER BY m.uid {direction} LIMIT {limit}
+MATCH (m)-[:SAID_BY]->(u:User)
+RETURN m.uid, u.uid, u.username, u.discriminator, m.content
+'''
+
+LATEST_QUERY = PAGE_QUERY.format(condition='', direction='DESC', limit='$limit')
+BEFORE_QUERY = PAGE_QUERY.format(condition='AND m.uid < $uid', direction='DESC', limit='$limit')
+AFTER_QUERY = PAGE_QUERY.format(condition='AND m.uid > $uid', direction='ASC', limit='$limit')
+AROUND_QUERY = '\nUNION ALL\n'.join((
+    PAGE_QUERY.format(condition='AND m.uid < $uid', direction='DESC', limit='$half'),
+    PAGE_QUERY.format(condition='AND m.uid > $uid', direction='ASC', limit='$half')))
+
+
+def insert_messages(messages):
+    """Create messages and move their channels' last_message_uid forward in
+    one transaction, returns the uids of the messages that were written"""
+    results, _ = run_transaction(CREATE_MESSAGES_QUERY, {'messages': messages})
+    return {uid for uids, in results for uid in uids}
+
+
+class MessageWriteService(Service):
+    """Writes messages in batches, a group commit.
+
+    Messages wait until `max_batch` of them are queued or the oldest has
+    waited `max_delay` seconds and are then written in one transaction by
+    one of `writers` tasks, messages keep queueing while those are busy.
+    Await the service with a message to get whether it was committed,
+    `await writer(db, uid, channel_uid, author_uid, content)`. A batch that
+    fails is written again one message at a time so only the callers whose
+    message can't be written get the error.
+    """
+    __slots__ = ('max_batch', 'max_delay', 'writers', '_db', '_pending', '_oldest',
+                 '_wakeup', '_full', '_tasks', '_closing')
+
+    def __init__(self, *args, max_batch=100, max_delay=0.005, writers=2, **kwargs):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.writers = writers
+        self._db = None
+        self._pending = deque()
+        self._oldest = 0
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._tasks = []
+        self._closing = False
+
+    async def __call__(self, db, uid, channel_uid, author_uid, content):
+        """Queue a message and wait for its batch to commit, False if its
+        channel or author didn't exist any more"""
+        if self._closing:
+            raise RuntimeError('the message writer is closed')
+        if not self._tasks:
+            self._db = db
+            self._tasks = [asyncio.ensure_future(self._run()) for _ in range(self.writers)]
+        future = asyncio.get_running_loop().create_future()
+        if not self._pending:
+            self._oldest = monotonic()
+        self._pending.append(({
+            'uid': uid,
+            'channel_uid': channel_uid,
+            'author_uid': author_uid,
+            'content': content}, future))
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        # the message is written even if the request goes away
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def close(self):
+        """Write the messages that are still queued and stop the writers"""
+        self._closing = True
+        self._wakeup.set()
+        self._full.set()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            delay = self._oldest + self.max_delay - monotonic()
+            if len(self._pending) < self.max_batch and delay > 0 and not self._closing:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [self._pending.popleft()
+                     for _ in range(min(self.max_batch, len(self._pending)))]
+            if not self._pending and not self._closing:
+                self._wakeup.clear()
+                self._full.clear()
+            if batch:
+                MESSAGE_BATCH_SIZE.observe(len(batch))
+                await self._write(batch)
+            elif self._closing:
+                return
+
+    async def _write(self, batch):
+        try:
+            written = await self._db(insert_messages, [message for message, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                for entry in batch:
+                    await self._write([entry])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for message, future in batch:
+            if not future.done():
+                future.set_result(message['uid'] in written)
+
+
+def message_history(channel_uid, board_uid, limit, before=None, after=None, around=None):
+    """Return a page of a channel's messages, oldest first.
+
+    Without a cursor this is the newest `limit` messages, `around` returns up
+    to half of `limit` on either side of the given uid.
+    """
+    params = {'channel_uid': channel_uid, 'limit': limit}
+    if around is not None:
+        query = AROUND_QUERY
+        params.update(uid=around, half=limit // 2)
+    elif before is not None:
+        query = BEFORE_QUERY
+        params['uid'] = before
+    elif after is not None:
+        query = AFTER_QUERY
+        params['uid'] = after
+    else:
+        query = LATEST_QUERY
+    results, _ = neodb.cypher_query(query, params)
+    results.sort(key=lambda row: row[0])
+    return [message_from_row((uid, channel_uid, board_uid, author_uid, username, discriminator, content))
+            for uid, author_uid, username, discriminator, content in results]
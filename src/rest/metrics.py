@@ -0,0 +1,336 @@
+"""Process metrics, served in the Prometheus text format on a local port"""
+import asyncio
+import contextvars
+import logging
+import threading
+from bisect import bisect_left
+from functools import partial, wraps
+from time import perf_counter
+from aiohttp import web
+from neomodel import db as neodb
+from roamrs import Extension
+from roamrs.auth import TokenValidator
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+FANOUT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{v}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        return [f'{self.name}{_labels(self.labels, k)} {v}' for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that is set, or read from `func` whenever metrics are
+    collected"""
+    kind = 'gauge'
+
+    def __init__(self, *args, func=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.func = func
+        self._values = {}
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        values = self._values
+        if self.func is not None:
+            values = {(): self.func()}
+        return [f'{self.name}{_labels(self.labels, k)} {v}' for k, v in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * (len(self.buckets) + 2)
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def samples(self):
+        lines = []
+        for labels, values in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket'
+                             f'{_labels(self.labels, labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket'
+                         f'{_labels(self.labels, labels, [("le", "+Inf")])} {values[-1]}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {values[-2]}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {values[-1]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request',
+    ('method', 'route', 'status')))
+REQUEST_QUERIES = REGISTRY.register(Histogram(
+    'http_request_db_queries', 'Database queries made while handling a request',
+    ('method', 'route'), buckets=COUNT_BUCKETS))
+REQUEST_QUERY_SECONDS = REGISTRY.register(Histogram(
+    'http_request_db_seconds', 'Time a request spent waiting on database queries',
+    ('method', 'route')))
+DB_QUERY_SECONDS = REGISTRY.register(Histogram(
+    'db_query_duration_seconds', 'Time taken by a single database query'))
+SNOWFLAKE_SECONDS = REGISTRY.register(Histogram(
+    'snowflake_fetch_duration_seconds', 'Time taken to fetch a snowflake from the snowflake host'))
+AUTH_SECONDS = REGISTRY.register(Histogram(
+    'auth_call_duration_seconds', 'Time taken by calls to the auth host', ('call',)))
+EVENT_FANOUT = REGISTRY.register(Histogram(
+    'gateway_event_fanout', 'Sessions an event was dispatched to', ('event',),
+    buckets=FANOUT_BUCKETS))
+DROPPED_FRAMES = REGISTRY.register(Counter(
+    'gateway_dropped_frames_total', 'Frames dropped from the queue of a connection that fell '
+    'too far behind, the connection is closed with 4010'))
+MESSAGE_BATCH_SIZE = REGISTRY.register(Histogram(
+    'message_write_batch_size', 'Messages written per transaction', buckets=COUNT_BUCKETS))
+LOOP_LAG_SECONDS = REGISTRY.register(Histogram(
+    'event_loop_lag_seconds', 'How late the event loop ran a timer, high values mean '
+    'something blocked it'))
+
+
+class RequestStats:
+    __slots__ = ('queries', 'query_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0
+
+
+# the stats of the request being handled, DatabaseService copies the context
+# into its threads so queries are counted against the request that made them
+REQUEST_STATS = contextvars.ContextVar('request_stats', default=None)
+
+
+def instrument_queries():
+    """Time every query neomodel sends, nodes and relationships included"""
+    original = neodb.cypher_query
+    if getattr(original, 'instrumented', False):
+        return
+
+    def cypher_query(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            DB_QUERY_SECONDS.observe(elapsed)
+            stats = REQUEST_STATS.get()
+            if stats is not None:
+                stats.queries += 1
+                stats.query_seconds += elapsed
+
+    cypher_query.instrumented = True
+    neodb.cypher_query = cypher_query
+
+
+def timed_route(method, path, func):
+    """Wrap a cog handler to record its latency and database use"""
+    method = method.value
+
+    @wraps(func)
+    async def wrapper(ctx):
+        stats = RequestStats()
+        token = REQUEST_STATS.set(stats)
+        status = 500
+        start = perf_counter()
+        try:
+            response = await func(ctx)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            REQUEST_STATS.reset(token)
+            REQUEST_SECONDS.observe(perf_counter() - start, method, path, status)
+            REQUEST_QUERIES.observe(stats.queries, method, path)
+            REQUEST_QUERY_SECONDS.observe(stats.query_seconds, method, path)
+    return wrapper
+
+
+class TimedTokenValidator(TokenValidator):
+    """The TokenValidator roamrs checks every request with, timing its calls
+    to the auth host"""
+
+    async def __call__(self, token):
+        start = perf_counter()
+        try:
+            return await super().__call__(token)
+        finally:
+            AUTH_SECONDS.observe(perf_counter() - start, 'verify')
+
+    async def get_user(self, token):
+        start = perf_counter()
+        try:
+            return await super().get_user(token)
+        finally:
+            AUTH_SECONDS.observe(perf_counter() - start, 'get_user')
+
+
+class LoopLagMonitor:
+    """Sleeps for `interval` over and over and records how much later than
+    asked it woke up, lags over `threshold` are logged as warnings"""
+
+    def __init__(self, interval=0.25, threshold=0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_lag = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0, loop.time() - expected)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                log.warning('event loop blocked for %.3fs', lag)
+
+
+class MetricsExtension(Extension):
+    """Serves REGISTRY and the gateway and database pool gauges at
+    http://host:port/metrics and runs the loop lag monitor, the port should
+    only be reachable from the host"""
+
+    def __init__(self, host='127.0.0.1', port=9100):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.monitor = LoopLagMonitor()
+        self.services = {}
+        self.extensions = {}
+        self._runner = None
+        self.registry = Registry()
+        for metric in REGISTRY.metrics:
+            self.registry.register(metric)
+        gauges = (
+            ('gateway_sessions', 'Gateway sessions, including ones waiting to be resumed',
+             lambda ws: len(ws.sessions)),
+            ('gateway_connections', 'Gateway sessions with an open connection',
+             lambda ws: len(ws.queue_depths())),
+            ('gateway_queued_frames', 'Frames waiting to be sent over every connection',
+             lambda ws: sum(ws.queue_depths().values())),
+            ('gateway_queue_depth_max', 'Frames waiting to be sent over the slowest connection',
+             lambda ws: max(ws.queue_depths().values(), default=0)))
+        for name, help, func in gauges:
+            self.registry.register(Gauge(name, help, func=partial(self._gateway, func)))
+        self.registry.register(Gauge(
+            'db_calls_pending', 'Database calls submitted and not finished',
+            func=lambda: self._db('pending')))
+        self.registry.register(Gauge(
+            'db_calls_queued', 'Database calls waiting for a free thread',
+            func=lambda: self._db('queue_depth')))
+        self.registry.register(Gauge(
+            'event_loop_lag_max_seconds', 'The longest the event loop has been blocked',
+            func=lambda: self.monitor.max_lag))
+
+    def _gateway(self, func):
+        ws = self.extensions.get('ws')
+        return 0 if ws is None else func(ws)
+
+    def _db(self, attribute):
+        db = self.services.get('db')
+        return 0 if db is None else getattr(db, attribute)
+
+    async def metrics(self, request):
+        return web.Response(
+            text=self.registry.render(), content_type='text/plain', charset='utf-8',
+            headers={'X-Prometheus-Format': '0.0.4'})
+
+    async def __call__(self, services, extensions):
+        self.services = services
+        self.extensions = extensions
+        app = web.Application()
+        app.add_routes([web.get('/metrics', self.metrics)])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.monitor.start()
+        log.info('serving metrics on http://%s:%d/metrics', self.host, self.port)
+
+    async def stop(self):
+        self.monitor.stop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,75 @@
+"""Data migrations, run with `python migrations.py <name>`"""
+import os
+import sys
+from neomodel import db as neodb
+
+BACKFILL_LAST_MESSAGE_UID_QUERY = '''
+MATCH (c:Channel) WHERE c.uid > $after
+WITH c ORDER BY c.uid LIMIT $batch_size
+OPTIONAL MATCH (m:Message)-[:POSTED_TO]->(c)
+WITH c, max(m.uid) AS last_message_uid
+SET c.last_message_uid = last_message_uid
+RETURN max(c.uid), count(c)
+'''
+
+
+def last_message_uid(batch_size=500):
+    """Store the uid of every channel's newest message on the channel"""
+    after = -1
+    total = 0
+    while True:
+        with neodb.transaction:
+            results, _ = neodb.cypher_query(
+                BACKFILL_LAST_MESSAGE_UID_QUERY, {'after': after, 'batch_size': batch_size})
+        last_uid, count = results[0]
+        if not count:
+            break
+        after = last_uid
+        total += count
+        print(f'{total} channels backfilled')
+
+
+MESSAGE_CHANNEL_INDEX_QUERY = '''
+CREATE INDEX message_channel_uid IF NOT EXISTS FOR (m:Message) ON (m.channel_uid, m.uid)
+'''
+
+BACKFILL_MESSAGE_CHANNEL_UID_QUERY = '''
+MATCH (m:Message)-[:POSTED_TO]->(c:Channel) WHERE m.channel_uid IS NULL
+WITH m, c LIMIT $batch_size
+SET m.channel_uid = c.uid
+RETURN count(m)
+'''
+
+
+def message_channel_uid(batch_size=5000):
+    """Copy every message's channel uid onto it and index it with the message
+    uid for history pagination"""
+    neodb.cypher_query(MESSAGE_CHANNEL_INDEX_QUERY)
+    total = 0
+    while True:
+        with neodb.transaction:
+            results, _ = neodb.cypher_query(
+                BACKFILL_MESSAGE_CHANNEL_UID_QUERY, {'batch_size': batch_size})
+        count = results[0][0]
+        if not count:
+            break
+        total += count
+        print(f'{total} messages backfilled')
+
+
+MIGRATIONS = {
+    'last_message_uid': last_message_uid,
+    'message_channel_uid': message_channel_uid,
+}
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+        print(f'usage: {sys.argv[0]} {{{",".join(MIGRATIONS)}}}')
+        sys.exit(1)
+    env = os.environ
+    neodb.set_connection(f'bolt://{env["DB_USER"]}:{env["DB_PASS"]}@{env["DB_HOST"]}:7687')
+    MIGRATIONS[sys.argv[1]]()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Moving channels around inside a board"""
+from neomodel import db as neodb
+
+CHANNEL_POSITIONS_QUERY = '''
+MATCH (c:Channel)-[:CHANNEL_OF]->(:Board {uid: $uid})
+RETURN c.uid, c.position
+'''
+
+REORDER_QUERY = '''
+UNWIND $channels AS moved
+MATCH (c:Channel {uid: moved.uid})-[:CHANNEL_OF]->(:Board {uid: $uid})
+SET c.position = moved.position
+'''
+
+
+class PositionConflict(ValueError):
+    pass
+
+
+def position_changes(current, positions):
+    """Check moving channels from their `current` positions to `positions`,
+    both map channel uids to positions, and return the moves that change
+    something.
+
+    New positions can't overlap each other or the position of a channel
+    that isn't being moved.
+    """
+    if not set(positions) <= set(current):
+        raise PositionConflict('Channel does not belong to this board')
+    taken = {p for uid, p in current.items() if uid not in positions}
+    if len(set(positions.values())) != len(positions) or taken & set(positions.values()):
+        raise PositionConflict('Positions cannot overlap')
+    return [{'uid': uid, 'position': position}
+            for uid, position in positions.items() if current[uid] != position]
+
+
+def reorder_channels(board_uid, positions):
+    """Move channels to new positions in one transaction.
+
+    `positions` maps channel uids to their new position, see
+    position_changes. Returns the channels whose position actually changed.
+    """
+    with neodb.transaction:
+        results, _ = neodb.cypher_query(CHANNEL_POSITIONS_QUERY, {'uid': board_uid})
+        changed = position_changes(dict(results), positions)
+        if changed:
+            neodb.cypher_query(REORDER_QUERY, {'uid': board_uid, 'channels': changed})
+    return changed
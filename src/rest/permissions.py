@@ -0,0 +1,127 @@
+"""Board permissions, resolved once per board and user and cached"""
+from enum import IntFlag
+from functools import wraps, reduce
+from operator import or_
+from aiohttp import web
+from neomodel import db as neodb
+from roamrs import Service
+from cache import LRUCache
+
+
+class Permissions(IntFlag):
+    ADMINISTRATOR = 8
+    MANAGE_CHANNELS = 16
+    MANAGE_GUILD = 32
+    VIEW_CHANNEL = 1024
+    SEND_MESSAGES = 2048
+    READ_MESSAGE_HISTORY = 65536
+
+ALL_PERMISSIONS = reduce(or_, Permissions)
+
+PERMISSIONS_QUERY = '''
+MATCH (:User {uid: $user_uid})-[s:SUBSCRIBED_TO]->(:Board {uid: $board_uid})
+MATCH (r:Role {uid: s.role})
+RETURN r.permissions
+'''
+
+CHANNEL_BOARD_QUERY = '''
+MATCH (:Channel {uid: $uid})-[:CHANNEL_OF]->(b:Board)
+RETURN b.uid
+'''
+
+
+def _query_permissions(board_uid, user_uid):
+    results, _ = neodb.cypher_query(
+        PERMISSIONS_QUERY, {'board_uid': board_uid, 'user_uid': user_uid})
+    if not results:
+        return None
+    permissions = Permissions(results[0][0] & ALL_PERMISSIONS)
+    if permissions & Permissions.ADMINISTRATOR:
+        return ALL_PERMISSIONS
+    return permissions
+
+
+def _query_channel_board(channel_uid):
+    results, _ = neodb.cypher_query(CHANNEL_BOARD_QUERY, {'uid': channel_uid})
+    if not results:
+        return None
+    return results[0][0]
+
+
+class PermissionService(Service):
+    """Resolves the permissions a user has on a board.
+
+    Results, including users that aren't subscribed, are cached per
+    (board uid, user uid). Anything that changes roles or subscriptions
+    has to call `invalidate`, which only reaches this process. Other workers
+    keep what they cached for up to `ttl` seconds, so keep it short when
+    there are several.
+    """
+    __slots__ = ('permissions', 'channel_boards')
+
+    def __init__(self, *args, maxsize=8192, ttl=60, **kwargs):
+        self.permissions = LRUCache(maxsize, ttl)
+        self.channel_boards = LRUCache(maxsize)
+
+    async def __call__(self, db, board_uid, user_uid):
+        """Return the user's permissions on the board or None if they aren't
+        subscribed to it"""
+        key = (board_uid, user_uid)
+        permissions = self.permissions.get(key, False)
+        if permissions is False:
+            permissions = await db(_query_permissions, board_uid, user_uid)
+            self.permissions.set(key, permissions)
+        return permissions
+
+    async def board_of(self, db, channel_uid):
+        board_uid = self.channel_boards.get(channel_uid)
+        if board_uid is None:
+            board_uid = await db(_query_channel_board, channel_uid)
+            if board_uid is not None:
+                self.channel_boards.set(channel_uid, board_uid)
+        return board_uid
+
+    def invalidate(self, board_uid=None, user_uid=None):
+        """Forget cached permissions for a board, a user or both"""
+        self.permissions.discard_where(
+            lambda k: (board_uid is None or k[0] == board_uid)
+            and (user_uid is None or k[1] == user_uid))
+
+    def forget_channel(self, channel_uid):
+        self.channel_boards.pop(channel_uid)
+
+
+def requires(*flags):
+    """Decorator for cog handlers that checks the requesting user has all of
+    `flags` on the board in the url, either directly or through the channel.
+
+    It has to go under `user_wrapper`, the board's uid and the resolved
+    permissions are put on `ctx.board_uid` and `ctx.permissions`.
+    """
+    needed = reduce(or_, flags, Permissions(0))
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(self, ctx):
+            resolver = ctx.services.get('permissions')
+            db = ctx.services.get('db')
+            try:
+                if 'board.id' in ctx.url_data:
+                    board_uid = int(ctx.url_data['board.id'])
+                else:
+                    board_uid = await resolver.board_of(db, int(ctx.url_data['channel.id']))
+            except (KeyError, ValueError):
+                raise web.HTTPBadRequest()
+            if board_uid is None:
+                raise web.HTTPBadRequest()
+            permissions = await resolver(db, board_uid, ctx.user.uid)
+            if permissions is None:
+                raise web.HTTPBadRequest()
+            if permissions & needed != needed:
+                missing = ', '.join(f.name for f in flags if not permissions & f)
+                raise web.HTTPForbidden(reason=f'Permission {missing} not set')
+            ctx.board_uid = board_uid
+            ctx.permissions = permissions
+            return await func(self, ctx)
+        return wrapper
+    return decorator
@@ -0,0 +1,109 @@
+"""Hand written Cypher projections used to serialize boards, channels and
+messages in a single query each, the dicts they build have the same keys in
+the same order as the ones jsonify used to build node by node"""
+from neomodel import db as neodb
+from snowflake import snowflake_to_time
+
+# channels created before last_message_uid was stored fall back to looking
+# through their messages until they have been backfilled
+LAST_MESSAGE_UID = '''coalesce(c.last_message_uid,
+                       reduce(last = null, uid IN [(m:Message)-[:POSTED_TO]->(c) | m.uid] |
+                              CASE WHEN last IS NULL OR uid > last THEN uid ELSE last END))'''
+
+BOARDS_QUERY = f'''
+MATCH (b:Board) WHERE b.uid IN $uids
+WITH b, head([(r:Role {{name: 'Owner'}})-[:ROLE_OF]->(b) | r.uid]) AS owner_role
+RETURN b.uid, b.name,
+       [(c:Channel)-[:CHANNEL_OF]->(b) |
+        [c.uid, c.type, c.name, c.topic, c.position, {LAST_MESSAGE_UID}]],
+       [(r:Role)-[:ROLE_OF]->(b) | [r.uid, r.name, r.permissions]],
+       [(u:User)-[s:SUBSCRIBED_TO]->(b) WHERE s.role = owner_role | u.uid]
+'''
+
+BOARD_CHANNELS_QUERY = f'''
+MATCH (c:Channel)-[:CHANNEL_OF]->(b:Board {{uid: $uid}})
+RETURN c.uid, c.type, c.name, c.topic, c.position, {LAST_MESSAGE_UID}
+'''
+
+CHANNEL_QUERY = f'''
+MATCH (c:Channel {{uid: $uid}})-[:CHANNEL_OF]->(b:Board)
+RETURN c.uid, c.type, c.name, c.topic, c.position, {LAST_MESSAGE_UID}, b.uid
+'''
+
+MESSAGES_QUERY = '''
+MATCH (m:Message) WHERE m.uid IN $uids
+MATCH (m)-[:POSTED_TO]->(c:Channel)-[:CHANNEL_OF]->(b:Board)
+MATCH (m)-[:SAID_BY]->(u:User)
+RETURN m.uid, c.uid, b.uid, u.uid, u.username, u.discriminator, m.content
+'''
+
+
+def _channel(row, board_uid):
+    uid, type_, name, topic, position, last_message_uid = row
+    j = {
+        'uid': uid,
+        'type': type_,
+        'name': name,
+        'topic': topic,
+        'position': position,
+        'board_uid': board_uid
+    }
+    if last_message_uid is not None:
+        j['last_message_uid'] = last_message_uid
+    return j
+
+
+def message_from_row(row):
+    uid, channel_uid, board_uid, author_uid, username, discriminator, content = row
+    return {
+        'uid': uid,
+        'channel_uid': channel_uid,
+        'board_uid': board_uid,
+        'author': {
+            'uid': author_uid,
+            'username': username,
+            'discriminator': discriminator
+        },
+        'timestamp': snowflake_to_time(uid),
+        'content': content
+    }
+
+
+def board_payloads(uids, requester_uid):
+    """Serialize several boards at once, returns a dict of uid to board"""
+    results, _ = neodb.cypher_query(BOARDS_QUERY, {'uids': list(uids)})
+    boards = {}
+    for uid, name, channels, roles, owner_uids in results:
+        boards[uid] = {
+            'uid': uid,
+            'name': name,
+            'channels': [_channel(c, uid) for c in channels],
+            'roles': [{'uid': r[0], 'name': r[1], 'permissions': r[2]} for r in roles],
+            'owner_uids': owner_uids,
+            'owner': requester_uid in owner_uids}
+    return boards
+
+
+def board_payload(uid, requester_uid):
+    return board_payloads([uid], requester_uid).get(uid)
+
+
+def board_channel_payloads(board_uid):
+    results, _ = neodb.cypher_query(BOARD_CHANNELS_QUERY, {'uid': board_uid})
+    return [_channel(row, board_uid) for row in results]
+
+
+def channel_payload(uid):
+    results, _ = neodb.cypher_query(CHANNEL_QUERY, {'uid': uid})
+    if not results:
+        return None
+    *row, board_uid = results[0]
+    return _channel(row, board_uid)
+
+
+def message_payloads(uids):
+    """Serialize a page of messages, keeping the order of `uids`"""
+    uids = list(uids)
+    results, _ = neodb.cypher_query(MESSAGES_QUERY, {'uids': uids})
+    messages = {row[0]: message_from_row(row) for row in results}
+    return [messages[uid] for uid in uids if uid in messages]
@@ -0,0 +1,110 @@
+"""Serialized bodies of reads that rarely change, revalidated with ETags"""
+import hashlib
+import json
+from aiohttp import web
+from roamrs import Service
+from cache import LRUCache, SingleFlight
+
+
+class CachedBody:
+    """A JSON body and its strong ETag, a hash of the body so every worker
+    gives the same content the same tag"""
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, data):
+        self.body = json.dumps(data).encode()
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=16).hexdigest() + '"'
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or tag.removeprefix('W/') == self.etag:
+                return True
+        return False
+
+    def response(self, request):
+        headers = {'ETag': self.etag, 'Cache-Control': 'private, no-cache'}
+        if self.matches(request.headers.get('If-None-Match')):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=self.body, content_type='application/json', headers=headers)
+
+
+class ResponseCacheService(Service):
+    """Caches response bodies under keys that include the version of the
+    entity they show, so bumping the version is all a write has to do.
+
+    Boards and users have versions. Channels are part of their board's
+    payload so their bodies are keyed by the board's version, anything that
+    changes a channel bumps its board. Versions are per process, entries
+    expire after `ttl` seconds which bounds how stale another worker's
+    writes can leave them.
+
+    Versions come from one counter that only goes up, an entity whose
+    version was evicted gets a new one and so can't match a body cached
+    before.
+    """
+    __slots__ = ('versions', 'payloads', 'bodies', '_clock', '_loads', '_builds')
+
+    def __init__(self, *args, maxsize=4096, ttl=30, **kwargs):
+        # (kind, uid) -> version
+        self.versions = LRUCache(maxsize)
+        self._clock = 0
+        self.payloads = LRUCache(maxsize, ttl)
+        self.bodies = LRUCache(maxsize, ttl)
+        self._loads = SingleFlight()
+        self._builds = SingleFlight()
+
+    async def __call__(self, request, key, db, func, *args):
+        """Respond with the JSON of `db(func, *args)`, built once for every
+        request for `key`. Returns None if func did"""
+        cached = self.bodies.get(key)
+        if cached is None:
+            cached = await self._builds(key, self._build, key, db, func, args)
+            if cached is None:
+                return None
+        return cached.response(request)
+
+    async def _build(self, key, db, func, args):
+        data = await db(func, *args)
+        if data is None:
+            return None
+        cached = CachedBody(data)
+        self.bodies.set(key, cached)
+        return cached
+
+    async def load(self, key, db, func, *args):
+        """The payload `db(func, *args)` returns, for payloads several bodies
+        are made from. None isn't cached"""
+        payload = self.payloads.get(key)
+        if payload is None:
+            payload = await self._loads(key, self._load, key, db, func, args)
+        return payload
+
+    async def _load(self, key, db, func, args):
+        payload = await db(func, *args)
+        if payload is not None:
+            self.payloads.set(key, payload)
+        return payload
+
+    def respond(self, request, key, make):
+        """Respond with the JSON of `make()`, called only if `key` isn't
+        cached"""
+        cached = self.bodies.get(key)
+        if cached is None:
+            cached = CachedBody(make())
+            self.bodies.set(key, cached)
+        return cached.response(request)
+
+    def version(self, kind, uid):
+        version = self.versions.get((kind, uid))
+        if version is None:
+            version = self.bump(kind, uid)
+        return version
+
+    def bump(self, kind, uid):
+        """Call after writing to an entity, the next read builds a new body"""
+        self._clock += 1
+        self.versions.set((kind, uid), self._clock)
+        return self._clock
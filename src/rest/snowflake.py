@@ -0,0 +1,143 @@
+"""Snowflake allocation, pooled from the snowflake host with a local fallback"""
+import asyncio
+import os
+from collections import deque
+from datetime import datetime
+from time import time, monotonic, perf_counter
+from aiohttp import ClientSession, ClientTimeout
+from roamrs import Service
+from metrics import SNOWFLAKE_SECONDS
+
+EPOCH = 1558915200
+
+TIMESTAMP_SHIFT = 22
+WORKER_SHIFT = 17
+PROCESS_SHIFT = 12
+INCREMENT_MASK = 0xfff
+
+
+def snowflake_to_time(snowflake):
+    snowflake = snowflake >> TIMESTAMP_SHIFT
+    snowflake += EPOCH
+    snowflake /= 1000
+    return datetime.utcfromtimestamp(snowflake).isoformat()
+
+
+class LocalSnowflakeGenerator:
+    """Generates snowflakes in process using the same bit layout as the
+    snowflake host, worker 31 is reserved for these so they can't collide with
+    remote ones. Processes on one host need different `process_id`s, it
+    defaults to the low bits of the pid which only suits a single process"""
+    __slots__ = ('worker_id', 'process_id', '_last', '_increment')
+
+    def __init__(self, worker_id=31, process_id=None):
+        if process_id is None:
+            process_id = os.getpid()
+        self.worker_id = worker_id & 0x1f
+        self.process_id = process_id & 0x1f
+        self._last = -1
+        self._increment = 0
+
+    def __call__(self):
+        # EPOCH is in milliseconds, see snowflake_to_time
+        now = int(time() * 1000) - EPOCH
+        if now <= self._last:
+            # same millisecond (or the clock went backwards), keep counting
+            # from the last timestamp and borrow the next one when we run out
+            now = self._last
+            self._increment = (self._increment + 1) & INCREMENT_MASK
+            if self._increment == 0:
+                now += 1
+        else:
+            self._increment = 0
+        self._last = now
+        return (now << TIMESTAMP_SHIFT
+                | self.worker_id << WORKER_SHIFT
+                | self.process_id << PROCESS_SHIFT
+                | self._increment)
+
+
+class SnowflakeService(Service):
+    """Hands out snowflakes from an in memory pool.
+
+    The pool is refilled in the background with batches of concurrent requests
+    whenever it drops to `low_watermark`, up to `high_watermark`. If the pool
+    is empty and the snowflake host doesn't answer within `timeout` seconds a
+    locally generated snowflake is returned instead, and keeps being returned
+    without waiting until a refill succeeds again. Pooled snowflakes older
+    than `max_age` seconds are thrown away so timestamps stay accurate, a
+    caller finding the pool empty only waits for the first batch of a refill.
+    `process_id` is passed on to the local generator.
+    """
+    __slots__ = ('url', 'batch_size', 'low_watermark', 'high_watermark',
+                 'timeout', 'max_age', 'fallbacks', '_pool', '_refill_task',
+                 '_healthy', '_local', '_fetched', '__session')
+
+    def __init__(self, url, *args, batch_size=32, low_watermark=16,
+                 high_watermark=128, timeout=0.25, max_age=1, process_id=None, **kwargs):
+        self.url = url
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.timeout = timeout
+        self.max_age = max_age
+        self.fallbacks = 0
+        self._pool = deque()
+        self._refill_task = None
+        self._healthy = True
+        self._local = LocalSnowflakeGenerator(process_id=process_id)
+        # set whenever a batch lands in the pool
+        self._fetched = asyncio.Event()
+        self.__session = None
+
+    async def __call__(self):
+        self._expire()
+        if len(self._pool) <= self.low_watermark:
+            self._schedule_refill()
+        if not self._pool and self._healthy:
+            self._fetched.clear()
+            try:
+                await asyncio.wait_for(self._fetched.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self._pool:
+            return self._pool.popleft()[1]
+        self.fallbacks += 1
+        return self._local()
+
+    def __len__(self):
+        return len(self._pool)
+
+    def _expire(self):
+        oldest = monotonic() - self.max_age
+        while self._pool and self._pool[0][0] < oldest:
+            self._pool.popleft()
+
+    def _schedule_refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _fetch(self):
+        start = perf_counter()
+        try:
+            async with self.__session.get(self.url) as resp:
+                return int((await resp.json())['snowflake'])
+        finally:
+            SNOWFLAKE_SECONDS.observe(perf_counter() - start)
+
+    async def _refill(self):
+        if self.__session is None:
+            self.__session = ClientSession(timeout=ClientTimeout(total=5))
+        while len(self._pool) < self.high_watermark:
+            count = min(self.batch_size, self.high_watermark - len(self._pool))
+            results = await asyncio.gather(
+                *(self._fetch() for _ in range(count)), return_exceptions=True)
+            fetched_at = monotonic()
+            snowflakes = sorted(r for r in results if isinstance(r, int))
+            self._pool.extend((fetched_at, s) for s in snowflakes)
+            self._healthy = len(snowflakes) == count
+            self._fetched.set()
+            if not self._healthy:
+                # the host is struggling, let the local generator cover
+                # until the next refill
+                return
@@ -0,0 +1,133 @@
+"""Runs the api as several worker processes.
+
+Every worker serves http on the same port through SO_REUSEPORT and is one
+shard of the gateway, events reach the other workers through an EventHub
+the supervisor runs.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+from aiohttp import web
+from roamrs import HTTPServer
+from bus import EventHub
+
+log = logging.getLogger(__name__)
+
+
+class WorkerServer(HTTPServer):
+    """An HTTPServer that can share its port with other workers and finishes
+    the requests it is serving before `exit` returns"""
+
+    def __init__(self, *args, reuse_port=False, drain_timeout=30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self._runner = None
+
+    async def __call__(self):
+        server = web.Server(self.router)
+        self._runner = web.ServerRunner(server, shutdown_timeout=self.drain_timeout)
+        await self._runner.setup()
+        site = web.TCPSite(
+            self._runner, self._host, self._port, reuse_port=self.reuse_port or None)
+        for extension in self.extensions.values():
+            await extension(self.services, self.extensions)
+        await site.start()
+        log.info('serving http on http://%s:%d/ (pid %d)', self._host, self._port, os.getpid())
+        await self._exit_event.wait()
+
+    async def exit(self):
+        """Stop accepting connections, close the gateway and wait for the
+        requests in flight"""
+        for extension in self.extensions.values():
+            await extension.stop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+        # messages of requests that timed out while draining are still queued
+        writer = self.services.get('message_writer')
+        if writer is not None:
+            await writer.close()
+        self._exit_event.set()
+
+
+class Supervisor:
+    """Keeps `workers` worker processes running.
+
+    Each worker is started with WORKER_INDEX and WORKER_COUNT set, a worker
+    that dies is started again after `restart_delay` seconds. SIGHUP
+    replaces the workers one at a time, each replacement gets
+    `start_grace` seconds to start listening before the worker it replaces
+    is asked to drain. SIGTERM and SIGINT drain every worker and exit, workers
+    still running after `drain_timeout` seconds are killed.
+    """
+
+    def __init__(self, workers, bus_path, argv=None, restart_delay=1, start_grace=5,
+                 drain_timeout=30):
+        self.workers = workers
+        self.bus_path = bus_path
+        self.argv = argv or [sys.executable] + sys.argv
+        self.restart_delay = restart_delay
+        self.start_grace = start_grace
+        self.drain_timeout = drain_timeout
+        # worker index -> the process serving it
+        self.processes = {}
+        self._stopping = False
+        self._done = None
+
+    async def _spawn(self, index):
+        env = dict(os.environ,
+                   WORKER_INDEX=str(index),
+                   WORKER_COUNT=str(self.workers),
+                   EVENT_BUS_PATH=self.bus_path)
+        process = await asyncio.create_subprocess_exec(*self.argv, env=env)
+        self.processes[index] = process
+        asyncio.ensure_future(self._watch(index, process))
+        return process
+
+    async def _watch(self, index, process):
+        code = await process.wait()
+        if self._stopping or self.processes.get(index) is not process:
+            return
+        log.warning('worker %d (pid %d) exited with %s, restarting', index, process.pid, code)
+        await asyncio.sleep(self.restart_delay)
+        if not self._stopping:
+            await self._spawn(index)
+
+    async def _drain(self, process):
+        if process.returncode is not None:
+            return
+        process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    async def restart(self):
+        """Replace every worker without closing the listening ports"""
+        for index in range(self.workers):
+            old = self.processes.get(index)
+            await self._spawn(index)
+            await asyncio.sleep(self.start_grace)
+            if old is not None:
+                await self._drain(old)
+
+    async def stop(self):
+        self._stopping = True
+        await asyncio.gather(*(self._drain(p) for p in self.processes.values()))
+        self._done.set()
+
+    async def __call__(self):
+        loop = asyncio.get_running_loop()
+        self._done = asyncio.Event()
+        hub = EventHub(self.bus_path)
+        await hub.start()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, lambda: asyncio.ensure_future(self.stop()))
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.restart()))
+        for index in range(self.workers):
+            await self._spawn(index)
+        await self._done.wait()
+        await hub.close()
@@ -0,0 +1,65 @@
+"""Templates for creating a board with its roles and channels in one write"""
+from dal import run_transaction
+
+CREATE_BOARD_QUERY = '''
+MATCH (owner:User {uid: $owner_uid})
+CREATE (b:Board {uid: $uid, name: $name})
+FOREACH (role IN $roles |
+    CREATE (:Role {uid: role.uid, name: role.name, permissions: role.permissions})-[:ROLE_OF]->(b))
+FOREACH (channel IN $channels |
+    CREATE (:Channel {uid: channel.uid, name: channel.name, type: channel.type,
+                      topic: channel.topic, position: channel.position})-[:CHANNEL_OF]->(b))
+CREATE (owner)-[:SUBSCRIBED_TO {role: $owner_role_uid}]->(b)
+WITH b
+UNWIND $role_parents AS link
+MATCH (child:Role {uid: link.child})-[:ROLE_OF]->(b)
+MATCH (parent:Role {uid: link.parent})-[:ROLE_OF]->(b)
+CREATE (child)-[:R_CHILD_OF]->(parent)
+'''
+
+
+class BoardTemplate:
+    """The roles and channels a new board starts with.
+
+    Roles are dicts with a name, permissions and optionally the name of their
+    parent role, channels are dicts with a name, type, topic and position.
+    Whoever creates the board is subscribed with `owner_role`.
+    """
+    __slots__ = ('roles', 'channels', 'owner_role')
+
+    def __init__(self, roles, channels, owner_role='Owner'):
+        self.roles = roles
+        self.channels = channels
+        self.owner_role = owner_role
+
+    async def params(self, snowflake, name, owner_uid):
+        """Give the board and everything in it a snowflake and return the
+        parameters for CREATE_BOARD_QUERY"""
+        uid = await snowflake()
+        roles = [dict(role, uid=await snowflake()) for role in self.roles]
+        channels = [dict(channel, uid=await snowflake()) for channel in self.channels]
+        role_uids = {role['name']: role['uid'] for role in roles}
+        return {
+            'uid': uid,
+            'name': name,
+            'owner_uid': owner_uid,
+            'owner_role_uid': role_uids[self.owner_role],
+            'roles': [{'uid': r['uid'], 'name': r['name'], 'permissions': r['permissions']}
+                      for r in roles],
+            'channels': channels,
+            'role_parents': [{'child': r['uid'], 'parent': role_uids[r['parent']]}
+                             for r in roles if r.get('parent')]}
+
+    async def create(self, db, snowflake, name, owner_uid):
+        """Create a board from this template, returns the new board's uid"""
+        params = await self.params(snowflake, name, owner_uid)
+        await db(run_transaction, CREATE_BOARD_QUERY, params)
+        return params['uid']
+
+
+DEFAULT_BOARD = BoardTemplate(
+    roles=[
+        {'name': 'Owner', 'permissions': 8},
+        {'name': 'everyone', 'permissions': 104324161, 'parent': 'Owner'}],
+    channels=[
+        {'name': 'general', 'type': 0, 'topic': 'general discussion', 'position': 0}])
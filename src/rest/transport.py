@@ -0,0 +1,91 @@
+"""Gateway frame encodings and compression, picked by the client when it
+connects"""
+import json
+import zlib
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+import msgpack
+
+ENCODINGS = ('json', 'msgpack')
+COMPRESSIONS = ('zlib-stream',)
+# every zlib-stream frame ends with this, clients buffer until they see it
+ZLIB_SUFFIX = b'\x00\x00\xff\xff'
+
+
+class TransportError(ValueError):
+    pass
+
+
+@lru_cache(maxsize=256)
+def _packed(frame):
+    """A JSON object frame as msgpack, split into its number of keys and
+    the packed keys and values"""
+    data = json.loads(frame)
+    body = msgpack.packb(data)
+    return len(data), body[len(_map_header(len(data))):]
+
+
+def _map_header(size):
+    return msgpack.Packer().pack_map_header(size)
+
+
+def to_msgpack(frame):
+    """Convert a JSON frame to msgpack, the rest of a sequenced frame
+    (`{"s": 1, ...}`) is only converted once for all of its recipients"""
+    seq = None
+    if frame.startswith('{"s": '):
+        end = frame.index(',', 6)
+        seq = int(frame[6:end])
+        frame = '{' + frame[end + 2:]
+    size, body = _packed(frame)
+    if seq is None:
+        return _map_header(size) + body
+    return _map_header(size + 1) + msgpack.packb('s') + msgpack.packb(seq) + body
+
+
+class Transport:
+    """How frames are written to and read from one connection.
+
+    `encode` turns a JSON frame into what the connection asked for.
+    `encoding=msgpack` sends and reads binary msgpack, see to_msgpack.
+    `compress=zlib-stream` shares one zlib context for the connection and
+    ends each frame with a sync flush. Per-message deflate is negotiated in
+    the websocket handshake instead.
+    """
+    __slots__ = ('encoding', 'compress', '_zlib')
+
+    def __init__(self, encoding='json', compress=None):
+        if encoding not in ENCODINGS:
+            raise TransportError(f'Unknown encoding {encoding}')
+        if compress is not None and compress not in COMPRESSIONS:
+            raise TransportError(f'Unknown compression {compress}')
+        self.encoding = encoding
+        self.compress = compress
+        self._zlib = zlib.compressobj() if compress == 'zlib-stream' else None
+
+    @classmethod
+    def from_path(cls, path):
+        """The transport asked for in the query of the url the client
+        connected to, `/?encoding=msgpack&compress=zlib-stream`"""
+        query = parse_qs(urlsplit(path or '').query)
+        return cls(query.get('encoding', ['json'])[0], query.get('compress', [None])[0])
+
+    def encode(self, frame):
+        """Turn a JSON frame into what is sent over the websocket"""
+        if self.encoding == 'msgpack':
+            frame = to_msgpack(frame)
+        if self._zlib is None:
+            return frame
+        if isinstance(frame, str):
+            frame = frame.encode()
+        return self._zlib.compress(frame) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def decode(self, data):
+        """Read a frame sent by the client, raises ValueError if it isn't
+        valid"""
+        if self.encoding == 'msgpack':
+            try:
+                return msgpack.unpackb(data)
+            except (msgpack.UnpackException, TypeError) as e:
+                raise ValueError(str(e)) from e
+        return json.loads(data)
@@ -1,7 +1,13 @@
 from aiohttp import web
 from roamrs import Cog, Method, route
 from db import User
-from utils import user_wrapper, jsonify
+from utils import user_wrapper, jsonify, EventType
+
+
+def _user_payload(uid):
+    user = User.nodes.first_or_none(uid=uid)
+    return None if user is None else jsonify(user)
+
 
 class UserCog(Cog):
     @route('/users/me/', Method.GET)
@@ -14,21 +20,35 @@ class UserCog(Cog):
 
     @route('/users/{user.id}', Method.GET)
     async def get_user(self, ctx):
+        db = ctx.services.get('db')
+        responses = ctx.services.get('responses')
         url_data = ctx.url_data
         if not url_data:
             raise web.HTTPBadRequest()
-        uid = url_data['user.id']
-        user = User.nodes.first_or_none(uid=uid)
-        if user is None:
+        try:
+            uid = int(url_data['user.id'])
+        except ValueError:
             raise web.HTTPBadRequest()
-        return ctx.respond(jsonify(user))
+        response = await responses(
+            ctx.raw_request, ('user', uid, responses.version('user', uid)),
+            db, _user_payload, uid)
+        if response is None:
+            raise web.HTTPBadRequest()
+        return response
 
     @route('/users/me/', Method.PATCH)
     @user_wrapper
     async def mod_me(self, ctx):
         sent_data = ctx.sent_data
+        db = ctx.services.get('db')
         user = ctx.user
         new_username = sent_data['username']
         user.username = new_username
-        user.save()
-        return ctx.respond(jsonify(user))
+        await db(user.save)
+        ctx.services.get('responses').bump('user', user.uid)
+        j = jsonify(user)
+        # message history shows the author's name, tell every board it is in
+        ws = ctx.extensions.get('ws')
+        for board in await db(list, user.boards):
+            await ws.event(EventType.USER_UPDATE, board.uid, payload=j)
+        return ctx.respond(j)
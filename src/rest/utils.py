@@ -1,12 +1,17 @@
-from aiohttp import ClientSession
 from functools import wraps
+from time import time
 import asyncio
-from datetime import datetime
+import logging
 from db import User, Board, Channel, Role, Message
 from roamrs import Service, Extension
 from enum import Enum
+from snowflake import EPOCH, SnowflakeService, snowflake_to_time
+from projections import board_payload, channel_payload, message_payloads
+from cache import LRUCache, SingleFlight
+from dal import run_transaction
+from aiohttp import web
 
-EPOCH = 1558915200
+log = logging.getLogger(__name__)
 
 class EventType(Enum):
     BOARD_CREATE = 'BOARD_CREATE'
@@ -15,124 +20,142 @@ class EventType(Enum):
     CHANNEL_CREATE = 'CHANNEL_CREATE'
     CHANNEL_UPDATE = 'CHANNEL_UPDATE'
     CHANNEL_DELETE = 'CHANNEL_DELETE'
+    CHANNEL_POSITIONS_UPDATE = 'CHANNEL_POSITIONS_UPDATE'
     MESSAGE_CREATE = 'MESSAGE_CREATE'
-
-class SnowflakeService(Service):
-    __slots__ = ('url', '__session')
-    def __init__(self, url, *args, **kwargs):
-        self.url = url
-        self.__session = ClientSession()
-
-    async def __call__(self):
-        async with self.__session.get(self.url) as resp:
-            return int((await resp.json())['snowflake'])
-
-
-class CheckForTime:
-    def __init__(self, timeout, callback):
-        self._timeout = timeout
-        self._counter = 0
-        self._callback = callback
-        self.task = asyncio.create_task(self._job())
-
-    async def _job(self):
-        result = False
-        while self._counter < self._timeout and not result:
-            await asyncio.sleep(1)
-            self._counter += 1
-            result = await self._callback()
-
-    def cancel(self):
-        self.task.cancel()
-
-
-class BoardDeleteTimer(CheckForTime):
-    def __init__(self, board, required_votes, websocket):
-        super().__init__(5*60, self.delete_board)
-        self.board = board
-        self.votes = []
-        self.votes_required = required_votes
-        self.ws = websocket
-
-    async def delete_board(self):
-        if len(self.votes) >= self.votes_required:
-            roles = self.board.roles
-            task = await self.ws.event(EventType.BOARD_DELETE, self.board.subscribers, board=self.board)
-            await task
-            for role in roles:
-                role.delete()
-            for channel in self.board.channel_children:
-                channel.delete()
-            self.board.delete()
-            return True
-        return False
+    USER_UPDATE = 'USER_UPDATE'
+
+DELETE_BOARD_QUERY = '''
+MATCH (b:Board {uid: $uid})
+FOREACH (n IN [(b)<-[:ROLE_OF]-(r:Role) | r] + [(b)<-[:CHANNEL_OF]-(c:Channel) | c] |
+    DETACH DELETE n)
+DETACH DELETE b
+'''
+
+
+# votes are kept on the board so every worker counts the same ones, they
+# aren't properties of the Board model so saving a board doesn't overwrite
+# them. Setting the lock property first makes concurrent votes wait for each
+# other before they read the votes, a round past its deadline starts over
+VOTE_QUERY = '''
+MATCH (b:Board {uid: $board_uid})
+SET b._delete_lock = true
+WITH b, coalesce(b.delete_deadline, 0) < $now AS expired
+WITH b,
+    CASE WHEN expired THEN [] ELSE b.delete_votes END AS votes,
+    CASE WHEN expired THEN $required ELSE b.delete_required END AS required,
+    CASE WHEN expired THEN $deadline ELSE b.delete_deadline END AS deadline
+SET b.delete_votes = CASE WHEN $user_uid IN votes THEN votes ELSE votes + $user_uid END,
+    b.delete_required = required,
+    b.delete_deadline = deadline
+REMOVE b._delete_lock
+RETURN size(b.delete_votes), required,
+    size(votes) < required AND size(b.delete_votes) >= required
+'''
 
 
 class BoardDeleteService(Service):
-    #__slots__ = ('timers', '_task', 'loop', 'ws')
-    def __init__(self, extensions):
+    """Counts votes to delete boards.
+
+    A board is deleted as soon as enough of its owners have voted, votes that
+    don't get there within `timeout` seconds are dropped by the next vote.
+    The votes are stored on the board so they are shared by every worker and
+    survive a restart.
+    """
+    def __init__(self, extensions, timeout=5*60):
         self.ws = extensions.get('ws')
-        self.timers = {}
-
-    def create(self, board, user, required_votes):
-        self.clear()
-        if self.timers.get(board.uid):
-            if user not in self.timers.get(board.uid).votes:
-                self.timers[board.uid].votes.append(user)
-        else:
-            self.timers[board.uid] = BoardDeleteTimer(board, required_votes, self.ws)
-            self.timers[board.uid].votes.append(user)
-
-    def clear(self):
-        self.timers = {b: t for b, t in self.timers.items() if not t.task.done()}
-
-def snowflake_to_time(snowflake):
-    snowflake = snowflake >> 22
-    snowflake += EPOCH
-    snowflake /= 1000
-    return datetime.utcfromtimestamp(snowflake).isoformat()
+        self.timeout = timeout
+        # deletes in progress, kept so they aren't garbage collected
+        self._deletes = set()
+
+    async def vote(self, db, board_uid, user_uid, required_votes):
+        """Count a user's vote to delete a board, returns how many votes it
+        has and how many it needs"""
+        now = time()
+        rows, _ = await db(run_transaction, VOTE_QUERY, {
+            'board_uid': board_uid, 'user_uid': user_uid, 'required': required_votes,
+            'now': now, 'deadline': now + self.timeout})
+        if not rows:
+            # deleted since the handler looked it up
+            return 0, required_votes
+        votes, required, passed = rows[0]
+        if passed:
+            task = asyncio.create_task(self._delete(board_uid))
+            self._deletes.add(task)
+            task.add_done_callback(self._deleted)
+        return votes, required
+
+    def _deleted(self, task):
+        self._deletes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error('deleting a board failed', exc_info=task.exception())
+
+    async def _delete(self, board_uid):
+        db = self.ws.services.get('db')
+        task = await self.ws.event(EventType.BOARD_DELETE, board_uid, payload={'uid': board_uid, 'unavailable': False})
+        await task
+        await db(run_transaction, DELETE_BOARD_QUERY, {'uid': board_uid})
+        self.ws.services.get('responses').bump('board', board_uid)
+        self.ws.services.get('permissions').invalidate(board_uid=board_uid)
+
+class TokenUserService(Service):
+    """Caches the user a token belongs to.
+
+    Invalid tokens are remembered for `negative_ttl` seconds and concurrent
+    lookups for the same token share one call to the auth host.
+    """
+    __slots__ = ('users', 'negative_ttl', '_lookups')
+
+    def __init__(self, *args, maxsize=10000, ttl=30, negative_ttl=5, **kwargs):
+        self.users = LRUCache(maxsize, ttl)
+        self.negative_ttl = negative_ttl
+        self._lookups = SingleFlight()
+
+    async def __call__(self, services, token):
+        """Return the User a token belongs to or None if it is invalid"""
+        user = self.users.get(token, False)
+        if user is not False:
+            return user
+        return await self._lookups(token, self._lookup, services, token)
+
+    async def _lookup(self, services, token):
+        auth = services.get('roamgg_token')
+        db = services.get('db')
+        user_details = await auth.get_user(token)
+        if not user_details:
+            self.users.set(token, None, ttl=self.negative_ttl)
+            return None
+        user = await db(User.nodes.first_or_none, uid=user_details['uid'])
+        self.users.set(token, user, ttl=None if user else self.negative_ttl)
+        return user
+
+    @property
+    def hits(self):
+        return self.users.hits
+
+    @property
+    def misses(self):
+        return self.users.misses
 
 
 def user_wrapper(func):
     @wraps(func)
-    async def wrapper(ctx):
-        auth = ctx.services.get('roamgg_token')
+    async def wrapper(self, ctx):
+        users = ctx.services.get('users')
         token_str = ctx.raw_request.headers.get('Authorization')
-        user_uid = (await auth.get_user(token_str))['uid']
-        user_object = User.nodes.first(uid=user_uid)
+        user_object = await users(ctx.services, token_str)
+        if user_object is None:
+            raise web.HTTPUnauthorized()
         ctx.user = user_object
-        return await func(ctx)
+        return await func(self, ctx)
     return wrapper
 
 
 def jsonify(o, **kwargs):
     if isinstance(o, Board):
         requester = kwargs['requester']
-        owner_role = o.roles.filter(name__exact='Owner').first()
-        owners = o.subscribers.match(role__exact=owner_role.uid)
-        return {
-            'uid': o.uid,
-            'name': o.name,
-            'channels': list(map(jsonify, o.channel_children)),
-            'roles': list(map(jsonify, o.roles)),
-            'owner_uids': [owner.uid for owner in owners],
-            'owner': requester in owners}
+        return board_payload(o.uid, requester.uid)
     elif isinstance(o, Channel):
-        if o.messages:
-            last_message = o.messages.order_by('-uid').first()
-        else:
-            last_message = None
-        j = {
-            'uid': o.uid,
-            'type': o.type,
-            'name': o.name,
-            'topic': o.topic,
-            'position': o.position,
-            'board_uid': o.board_parent.single().uid
-        }
-        if last_message:
-            j['last_message_uid'] = last_message.uid
-        return j
+        return channel_payload(o.uid)
     elif isinstance(o, Role):
         return {
             'uid': o.uid,
@@ -146,14 +169,4 @@ def jsonify(o, **kwargs):
             'discriminator': o.discriminator
         }
     elif isinstance(o, Message):
-        channel = o.channel.single()
-        board = channel.board_parent.single()
-        author = o.author.single()
-        return {
-            'uid': o.uid,
-            'channel_uid': channel.uid,
-            'board_uid': board.uid,
-            'author': jsonify(author),
-            'timestamp': snowflake_to_time(o.uid),
-            'content': o.content
-        }
+        return message_payloads([o.uid])[0]
@@ -1,150 +1,646 @@
 import asyncio
+import logging
+import secrets
 import websockets
 import json
-from db import User
-from time import time
+from collections import deque, OrderedDict
+from time import time, monotonic
 from roamrs import Extension
-from enum import Enum
-from aiostream import stream, pipe
 from utils import jsonify, EventType
+from projections import board_payloads
+from transport import Transport, TransportError
+from metrics import DROPPED_FRAMES, EVENT_FANOUT
+
+log = logging.getLogger(__name__)
+
+BOARD_EVENTS = (EventType.BOARD_CREATE, EventType.BOARD_UPDATE)
+CHANNEL_EVENTS = (EventType.CHANNEL_CREATE, EventType.CHANNEL_UPDATE, EventType.CHANNEL_DELETE)
+# events that only matter in their latest version, queued ones are replaced
+COALESCED_EVENTS = (EventType.BOARD_UPDATE, EventType.CHANNEL_UPDATE)
+
+
+def encode_event(event, payload):
+    return json.dumps({'op': 0, 't': event.value, 'd': payload})
+
+
+def event_frames(event, payload):
+    """Encode an event once for all of its recipients.
+
+    Returns a function from a recipient's uid to the frame they should get,
+    boards are encoded twice as the `owner` flag depends on the recipient.
+    """
+    if event in BOARD_EVENTS:
+        owners = frozenset(payload['owner_uids'])
+        frame = encode_event(event, dict(payload, owner=False))
+        owner_frame = encode_event(event, dict(payload, owner=True))
+        return lambda uid: owner_frame if uid in owners else frame
+    frame = encode_event(event, payload)
+    return lambda uid: frame
+
+
+def event_payload(event, kwargs):
+    """Serialize the object an event is about, this runs on the db pool"""
+    if event in BOARD_EVENTS:
+        board = kwargs.get('board')
+        return board_payloads([board.uid], None).get(board.uid)
+    elif event is EventType.BOARD_DELETE:
+        return {'uid': kwargs.get('board').uid, 'unavailable': False}
+    elif event in CHANNEL_EVENTS:
+        return jsonify(kwargs.get('channel'))
+    elif event is EventType.MESSAGE_CREATE:
+        return jsonify(kwargs.get('message'))
+
+
+def shard_of(user_uid, shard_count):
+    """The gateway shard a user belongs to.
+
+    The low bits of a snowflake are its increment and process id, which are
+    the same for most uids, so the uid is spread with Fibonacci hashing first.
+    """
+    return ((user_uid * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF) >> 32) % shard_count
+
+
+class EventQueue:
+    """A connection's outgoing frames.
+
+    Frames queued with a `key` replace the frame queued earlier with the same
+    key, it is dropped and the new one goes to the back. The queue holds at
+    most `maxsize` frames, past that the connection is flagged `overflowing`
+    and the oldest frames are dropped once it holds twice as many.
+    """
+    __slots__ = ('maxsize', 'over_since', 'dropped', '_entries', '_keys', '_size',
+                 '_ready', '_drained')
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        # when the queue last went over maxsize, None while it is under it
+        self.over_since = None
+        self.dropped = 0
+        # [key, event, frame] lists, frame is None for replaced entries
+        self._entries = deque()
+        self._keys = {}
+        self._size = 0
+        self._ready = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    def __len__(self):
+        return self._size
+
+    def put(self, event, frame, key=None):
+        if key is not None:
+            previous = self._keys.pop(key, None)
+            if previous is not None:
+                previous[2] = None
+                self._size -= 1
+        entry = [key, event, frame]
+        self._entries.append(entry)
+        if key is not None:
+            self._keys[key] = entry
+        self._size += 1
+        while self._size > 2 * self.maxsize:
+            self._pop()
+            self.dropped += 1
+        if self._size > self.maxsize and self.over_since is None:
+            self.over_since = monotonic()
+        self._ready.set()
+        self._drained.clear()
+
+    def _pop(self):
+        while True:
+            key, event, frame = self._entries.popleft()
+            if frame is not None:
+                break
+        if key is not None:
+            del self._keys[key]
+        self._size -= 1
+        if self._size <= self.maxsize:
+            self.over_since = None
+        if not self._size:
+            self._entries.clear()
+            self._ready.clear()
+            self._drained.set()
+        return event, frame
+
+    async def get(self):
+        await self._ready.wait()
+        return self._pop()
+
+    async def drained(self):
+        """Wait until every queued frame has been taken"""
+        await self._drained.wait()
+
+
+class HeartbeatSweeper:
+    """Closes connections that stop sending heartbeats.
+
+    Every connection has the same timeout so ordering them by their last
+    heartbeat orders them by deadline, a heartbeat just moves the connection
+    to the back. One task sleeps until the earliest deadline instead of every
+    connection polling its own.
+    """
+    __slots__ = ('timeout', 'resolution', '_deadlines', '_wakeup')
+
+    def __init__(self, timeout=25, resolution=1):
+        self.timeout = timeout
+        self.resolution = resolution
+        # handler -> deadline, earliest first
+        self._deadlines = OrderedDict()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def beat(self, handler):
+        self._deadlines[handler] = monotonic() + self.timeout
+        self._deadlines.move_to_end(handler)
+        self._wakeup.set()
+
+    def remove(self, handler):
+        self._deadlines.pop(handler, None)
+
+    async def run(self):
+        while True:
+            if not self._deadlines:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = monotonic()
+            while self._deadlines:
+                handler, deadline = next(iter(self._deadlines.items()))
+                if deadline > now:
+                    break
+                del self._deadlines[handler]
+                log.info('closing session %s, no heartbeat', handler.session_id)
+                asyncio.ensure_future(handler.close(4009, 'Too slow'))
+            if self._deadlines:
+                # expiries are batched, a heartbeat moving the head back
+                # shouldn't wake the sweeper right away
+                deadline = next(iter(self._deadlines.values()))
+                await asyncio.sleep(max(deadline - now, self.resolution))
+
 
 class RoamWebSocketHandler:
-    def __init__(self, websocket, user):
+    """A user's gateway session.
+
+    Every dispatched event gets the next sequence number and is kept in a
+    bounded replay buffer. The session outlives its websocket for a grace
+    period so a client can resume it and get only the events it missed.
+
+    Full board payloads aren't part of READY, they are streamed afterwards
+    `chunk_size` boards at a time. Boards the client asks for with op 8 jump
+    the line, and the next chunk is only fetched once the queued events have
+    been sent so live events never wait behind a backlog of boards.
+    """
+    def __init__(self, user, db, replay_size=2000, streams=None, chunk_size=25, sweeper=None,
+                 queue_size=1000, slow_timeout=10):
         self.user = user
-        self.events = asyncio.Queue()
+        self.db = db
+        self.sweeper = sweeper
+        self.queue_size = queue_size
+        self.slow_timeout = slow_timeout
+        self.session_id = secrets.token_hex(16)
+        self.seq = 0
+        self.replay = deque(maxlen=replay_size)
+        self.boards = set()
+        # boards whose full payload hasn't been sent yet, in the order they
+        # will be, the value is unused
+        self.pending_boards = OrderedDict()
+        self.streams = streams or asyncio.Semaphore(1)
+        self.chunk_size = chunk_size
+        self._boards_wanted = asyncio.Event()
+        self.websocket = None
+        self.transport = None
+        self.events = None
+        self.expiry = None
         self.last_heartbeat = time()
         self._stop = asyncio.Event()
+
+    def attach(self, websocket, transport):
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
         self.websocket = websocket
+        self.transport = transport
+        self.events = EventQueue(self.queue_size)
+        self.last_heartbeat = time()
+        self._stop = asyncio.Event()
+        if self.sweeper is not None:
+            self.sweeper.beat(self)
+
+    def detach(self):
+        self.websocket = None
+        self.transport = None
+        self.events = None
+        if self.sweeper is not None:
+            self.sweeper.remove(self)
+
+    def take_over(self):
+        """Stop serving the connection that is attached and close it, so the
+        session can be resumed on another one"""
+        websocket = self.websocket
+        self._stop.set()
+        self.detach()
+        asyncio.ensure_future(websocket.close(4011, 'Session resumed on another connection'))
+
+    async def send(self, frame):
+        await self.websocket.send(self.transport.encode(frame))
+
+    async def close(self, code, reason):
+        if self.websocket is not None:
+            await self.websocket.close(code, reason)
+        self._stop.set()
+
+    @property
+    def queue_depth(self):
+        return 0 if self.events is None else len(self.events)
+
+    def dispatch(self, event, frame, key=None):
+        """Number an encoded event, remember it for resuming and queue it if
+        the session has a websocket.
+
+        A connection that has had more than `queue_size` frames waiting for
+        `slow_timeout` seconds is closed with 4010, and so is one that had
+        frames dropped so the client knows it has a gap to resume over.
+        """
+        self.seq += 1
+        frame = f'{{"s": {self.seq}, {frame[1:]}'
+        self.replay.append((self.seq, frame))
+        if self.events is None or self._stop.is_set():
+            return
+        dropped = self.events.dropped
+        self.events.put(event, frame, key)
+        over_since = self.events.over_since
+        if self.events.dropped > dropped:
+            DROPPED_FRAMES.inc(amount=self.events.dropped - dropped)
+        elif over_since is None or monotonic() - over_since <= self.slow_timeout:
+            return
+        self._stop.set()
+        log.info('closing session %s, %d frames behind', self.session_id, self.queue_depth)
+        asyncio.ensure_future(self.websocket.close(4010, 'Too slow to keep up'))
+
+    def want_boards(self, board_uids, first=False):
+        """Queue full payloads for boards of the session, `first` puts them
+        in front of the boards already waiting"""
+        for board_uid in board_uids:
+            if board_uid not in self.boards:
+                continue
+            self.pending_boards[board_uid] = None
+            if first:
+                self.pending_boards.move_to_end(board_uid, last=False)
+        if self.pending_boards:
+            self._boards_wanted.set()
+
+    def forget_board(self, board_uid):
+        self.boards.discard(board_uid)
+        self.pending_boards.pop(board_uid, None)
+
+    def missed(self, seq):
+        """The frames dispatched after `seq`, None if some of them aren't in
+        the replay buffer anymore"""
+        if seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.replay or self.replay[0][0] > seq + 1:
+            return None
+        return [frame for s, frame in self.replay if s > seq]
 
     async def stop(self):
         self._stop.set()
 
     async def __call__(self):
-        t1 = asyncio.create_task(self._keep_alive())
-        t2 = asyncio.create_task(self._handle_msg())
-        t3 = asyncio.create_task(self._handle_event())
-        async for board in stream.iterate(self.user.boards):
-            await self.events.put((EventType.BOARD_CREATE, board))
-        await asyncio.wait([t1, t2, t3])
+        tasks = [
+            asyncio.create_task(self._handle_msg()),
+            asyncio.create_task(self._handle_event()),
+            asyncio.create_task(self._stream_boards()),
+            asyncio.create_task(self._stop.wait())]
+        _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
 
     async def _handle_event(self):
         while True:
-            event, kwargs = await self.events.get()
-            print(f'Event is: {event}')
-            print(f'Kwargs are: {kwargs}')
-            data = {'op': 0, 't': event.value}
-            if event in [EventType.BOARD_CREATE, EventType.BOARD_UPDATE]:
-                data['d'] = jsonify(kwargs.get('board'), requester=self.user)
-            elif event is EventType.BOARD_DELETE:
-                data['d'] = {'uid': kwargs.get('board').uid, 'unavailable': False}
-            elif event in [EventType.CHANNEL_CREATE, EventType.CHANNEL_UPDATE, EventType.CHANNEL_DELETE]:
-                data['d'] = jsonify(kwargs.get('channel'))
-            elif event in [EventType.MESSAGE_CREATE]:
-                data['d'] = jsonify(kwargs.get('message'))
-            await self.websocket.send(json.dumps(data))
+            event, frame = await self.events.get()
+            await self.send(frame)
+
+    async def _stream_boards(self):
+        while True:
+            await self._boards_wanted.wait()
+            await self.events.drained()
+            chunk = []
+            while self.pending_boards and len(chunk) < self.chunk_size:
+                chunk.append(self.pending_boards.popitem(last=False)[0])
+            if not self.pending_boards:
+                self._boards_wanted.clear()
+            if not chunk:
+                continue
+            async with self.streams:
+                boards = await self.db(board_payloads, chunk, self.user.uid)
+            for board_uid, board in boards.items():
+                # the board may have been deleted while it was fetched
+                if board_uid in self.boards:
+                    self.dispatch(EventType.BOARD_CREATE, encode_event(EventType.BOARD_CREATE, board))
 
     async def _handle_msg(self):
         incorrect_blips = 0
         while True:
             try:
-                msg = json.loads(await asyncio.wait_for(self.websocket.recv(), timeout=1))
-            except asyncio.TimeoutError:
-                pass
-            else:
-                if msg['op'] == 1:
-                    if time() - self.last_heartbeat < 15:
-                        if incorrect_blips == 5:
-                            await self.websocket.close(4008, 'Too fast, slow down')
-                            self._stop.set()
-                            return
-                        await self.websocket.send(json.dumps({'op': 12}))
-                        incorrect_blips += 1
-                    else:
-                        await self.websocket.send(json.dumps({'op': 11}))
-                        self.last_heartbeat = time()
-                        incorrect_blips = 0
-                elif msg['op'] == 2:
-                    await self.websocket.close(4005, 'Already authenticated')
-                    self._stop.set()
-                    return
-
-    async def _keep_alive(self):
-        while True:
-            await asyncio.sleep(1)
-            if time() - self.last_heartbeat > 25:
-                await self.websocket.close(4009, 'Too slow')
-                self._stop.set()
+                msg = self.transport.decode(await self.websocket.recv())
+            except websockets.ConnectionClosed:
+                return
+            if msg['op'] == 1:
+                if time() - self.last_heartbeat < 15:
+                    if incorrect_blips == 5:
+                        await self.close(4008, 'Too fast, slow down')
+                        return
+                    await self.send(json.dumps({'op': 12}))
+                    incorrect_blips += 1
+                else:
+                    await self.send(json.dumps({'op': 11}))
+                    self.last_heartbeat = time()
+                    if self.sweeper is not None:
+                        self.sweeper.beat(self)
+                    incorrect_blips = 0
+            elif msg['op'] == 8:
+                try:
+                    board_uids = [int(uid) for uid in msg['d']['board_uids']]
+                except (KeyError, TypeError, ValueError):
+                    continue
+                self.want_boards(board_uids, first=True)
+            elif msg['op'] == 2:
+                await self.close(4005, 'Already authenticated')
                 return
 
 class WebSocketExtension(Extension):
-    def __init__(self, host, port):
+    def __init__(self, host, port, session_grace=60, replay_size=2000,
+                 board_streams=16, board_chunk_size=25, queue_size=1000, slow_timeout=10,
+                 deflate=True, shard=0, shard_count=1):
         super().__init__()
         self.host = host
         self.port = port
+        # with several shards each one also listens on port + 1 + shard and
+        # only takes the users that shard_of gives it
+        self.shard = shard
+        self.shard_count = shard_count
+        # offer per-message deflate to clients that ask for it in the handshake
+        self.deflate = deflate
+        self.session_grace = session_grace
+        # at least twice queue_size, so a connection closed for falling too
+        # far behind can still resume
+        self.replay_size = replay_size
+        self.board_chunk_size = board_chunk_size
+        self.queue_size = queue_size
+        self.slow_timeout = slow_timeout
+        # limits how many sessions fetch board payloads at the same time
+        self.board_streams = asyncio.Semaphore(board_streams)
+        self.sweeper = HeartbeatSweeper()
         self._stop = asyncio.Event()
+        # user uid -> that user's sessions
         self.handlers = {}
+        # board uid -> sessions of the board's subscribers that are online
+        self.boards = {}
+        # session id -> session, including ones waiting to be resumed
+        self.sessions = {}
         self.services = None
         self.extensions = None
+        self.bus = None
+        self._server_task = None
+
+    def queue_depths(self):
+        """Frames waiting to be sent, per session id of every connected
+        session"""
+        return {
+            handler.session_id: handler.queue_depth
+            for connections in self.handlers.values()
+            for handler in connections
+            if handler.websocket is not None}
+
+    def _add_online(self, board_uid, handler):
+        online = self.boards.get(board_uid)
+        if online is None:
+            online = self.boards[board_uid] = set()
+            self.bus.subscribe(board_uids=[board_uid])
+        online.add(handler)
+
+    def _remove_online(self, board_uid, handler):
+        online = self.boards.get(board_uid)
+        if online is not None:
+            online.discard(handler)
+            if not online:
+                del self.boards[board_uid]
+                self.bus.unsubscribe(board_uids=[board_uid])
+
+    def _subscribe(self, handler, board_uid):
+        handler.boards.add(board_uid)
+        self._add_online(board_uid, handler)
+
+    def _connect(self, handler):
+        connections = self.handlers.get(handler.user.uid)
+        if connections is None:
+            connections = self.handlers[handler.user.uid] = set()
+            self.bus.subscribe(user_uids=[handler.user.uid])
+        connections.add(handler)
+        for board_uid in handler.boards:
+            self._add_online(board_uid, handler)
+
+    def _detach(self, handler, websocket):
+        if handler.websocket is not websocket:
+            # the session was resumed on another connection
+            return
+        handler.detach()
+        handler.expiry = asyncio.get_running_loop().call_later(
+            self.session_grace, self._disconnect, handler)
 
-    async def _event(self, event, users, **kwargs):
-        print('assigning event!')
-        handlers = (stream.iterate(users)
-                         | pipe.filter(lambda u: u.uid in self.handlers)
-                         | pipe.map(lambda u: self.handlers.get(u.uid)))
-        async with handlers.stream() as handlers:
-            async for handler in handlers:
-                print(f'assigning event to: {handler.user.username}#{handler.user.discriminator}')
-                await handler.events.put((event, kwargs))
-
-    async def event(self, event, users, **kwargs):
-        print('event started!')
-        return asyncio.create_task(self._event(event, users, **kwargs))
-
-    async def handler(self, websocket, path):
-        auth = self.services.get('roamgg_token')
-        await websocket.send(json.dumps({
-            'op': 10,
-            'd': {'heartbeat_interval': 20000}}))
+    def _disconnect(self, handler):
+        self.sessions.pop(handler.session_id, None)
+        connections = self.handlers.get(handler.user.uid)
+        if connections is not None:
+            connections.discard(handler)
+            if not connections:
+                del self.handlers[handler.user.uid]
+                self.bus.unsubscribe(user_uids=[handler.user.uid])
+        for board_uid in handler.boards:
+            self._remove_online(board_uid, handler)
+
+    async def _deliver(self, event, board_uid, payload, user_uids):
+        """Send an event from the bus to the sessions in this process"""
+        frame_for = event_frames(event, payload)
+        key = (event, payload['uid']) if event in COALESCED_EVENTS else None
+        for user_uid in user_uids or ():
+            for handler in self.handlers.get(user_uid, ()):
+                self._subscribe(handler, board_uid)
+        if event is EventType.BOARD_DELETE:
+            # the board's subscribers still get the event they are removed for
+            online = set(self.boards.get(board_uid, ()))
+            for handler in online:
+                handler.forget_board(board_uid)
+                self._remove_online(board_uid, handler)
+        else:
+            online = self.boards.get(board_uid, ())
+        EVENT_FANOUT.observe(len(online), event.value)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('dispatching %s of board %s to %d sessions', event.value, board_uid, len(online))
+        for handler in list(online):
+            handler.dispatch(event, frame_for(handler.user.uid), key)
+
+    async def _event(self, event, board_uid, users=None, payload=None, **kwargs):
+        if payload is None:
+            payload = await self.services.get('db')(event_payload, event, kwargs)
+        user_uids = None if users is None else [user.uid for user in users]
+        await self.bus.publish(event, board_uid, payload, user_uids)
+
+    async def event(self, event, board_uid, **kwargs):
+        """Publish an event to the online subscribers of a board, wherever
+        their gateway runs.
+
+        Pass `users` to subscribe those users' connections to the board first,
+        and `payload` if the handler already serialized the object the event
+        is about.
+        """
+        return asyncio.create_task(self._event(event, board_uid, **kwargs))
+
+    async def handler(self, websocket, path=None):
+        """Identify or resume a connection, the encoding and compression
+        frames use are picked with the query of `path`, see transport.Transport"""
+        if path is None:
+            # newer websockets only pass the connection
+            path = websocket.request.path
+        users = self.services.get('users')
+        db = self.services.get('db')
         try:
-            identify = json.loads(await websocket.recv())
-        except json.decoder.JSONDecodeError:
+            transport = Transport.from_path(path)
+        except TransportError as e:
+            await websocket.close(4012, str(e))
+            return
+        hello = {'heartbeat_interval': 20000}
+        if self.shard_count > 1:
+            # clients that know their uid can work out their shard with
+            # shard_of and connect to its port instead of being sent there
+            hello['shards'] = {'count': self.shard_count, 'first_port': self.port + 1}
+        await websocket.send(transport.encode(json.dumps({'op': 10, 'd': hello})))
+        try:
+            identify = transport.decode(await websocket.recv())
+        except ValueError:
             await websocket.close(4002, 'What was that?')
             return
         try:
+            if identify['op'] == 6:
+                await self._resume(websocket, transport, identify['d'])
+                return
             if identify['op'] != 2:
                 await websocket.close(4003, 'Not authenticated')
                 return
             token_data = identify['d']['token']
-        except KeyError:
+        except (KeyError, TypeError, ValueError):
             await websocket.close(4001, 'The identify payload was not valid')
             return
-        user_details = await auth.get_user(token_data)
-        if user_details == {}:
+        user_object = await users(self.services, token_data)
+        if user_object is None:
+            await websocket.close(4004, 'The token you sent is invalid')
+            return
+        if not await self._check_shard(websocket, transport, user_object):
+            return
+        handler = RoamWebSocketHandler(
+            user_object, db, self.replay_size, self.board_streams,
+            self.board_chunk_size, self.sweeper, self.queue_size, self.slow_timeout)
+        handler.attach(websocket, transport)
+        boards = await db(list, user_object.boards)
+        handler.boards.update(b.uid for b in boards)
+        handler.want_boards(b.uid for b in boards)
+        self.sessions[handler.session_id] = handler
+        self._connect(handler)
+        try:
+            await handler.send(json.dumps({
+                'op': 0,
+                'd': {
+                    'user': jsonify(user_object),
+                    'session_id': handler.session_id,
+                    'boards': [{'uid': b.uid, 'unavailable': True} for b in boards]},
+                't': 'READY'
+            }))
+            await handler()
+        finally:
+            self._detach(handler, websocket)
+
+    def shard_of(self, user_uid):
+        return shard_of(user_uid, self.shard_count)
+
+    async def _check_shard(self, websocket, transport, user):
+        """Close connections of users that belong to another shard, telling
+        them which port that shard listens on"""
+        shard = self.shard_of(user.uid)
+        if shard == self.shard:
+            return True
+        port = self.port + 1 + shard
+        await websocket.send(transport.encode(json.dumps({
+            'op': 7, 'd': {'shard': shard, 'port': port}})))
+        await websocket.close(4013, f'Wrong shard, connect to port {port}')
+        return False
+
+    async def _resume(self, websocket, transport, data):
+        """Reattach a websocket to a session and replay what it missed"""
+        users = self.services.get('users')
+        token_data, session_id, seq = data['token'], data['session_id'], int(data['seq'])
+        user_object = await users(self.services, token_data)
+        if user_object is None:
             await websocket.close(4004, 'The token you sent is invalid')
             return
-        user_object = User.nodes.first(uid=user_details['uid'])
-        handler = RoamWebSocketHandler(websocket, user_object)
-        boards = user_object.boards
-        self.handlers[user_details['uid']] = handler
-        await websocket.send(json.dumps({
-            'op': 0,
-            'd': {
-                'user': jsonify(user_object),
-                'boards': [{'uid': b.uid, 'unavailable': True} for b in boards]},
-            't': 'READY'
-        }))
-        await handler()
+        if not await self._check_shard(websocket, transport, user_object):
+            return
+        handler = self.sessions.get(session_id)
+        missed = None
+        if handler is not None and handler.user.uid == user_object.uid:
+            missed = handler.missed(seq)
+        if missed is None:
+            await websocket.send(transport.encode(json.dumps({'op': 9, 'd': False})))
+            await websocket.close(4006, 'Session is no longer valid')
+            return
+        if handler.websocket is not None:
+            # the old connection usually died without closing and hasn't
+            # missed a heartbeat yet
+            handler.take_over()
+        handler.attach(websocket, transport)
+        try:
+            for frame in missed:
+                await handler.send(frame)
+            # not sequenced, like READY, so it is never replayed
+            await handler.send(json.dumps({'op': 0, 't': 'RESUMED', 'd': {}}))
+            await handler()
+        finally:
+            self._detach(handler, websocket)
 
     async def __call__(self, services, extensions):
         self.services = services
         self.extensions = extensions
-        asyncio.create_task(self._start())
+        self.bus = services.get('bus')
+        self.bus.listen(self._deliver)
+        await self.bus.start()
+        self._server_task = asyncio.create_task(self._start())
 
     async def _start(self):
-        async with websockets.serve(self.handler, self.host, self.port):
-            await self._stop.wait()
+        sweeper = asyncio.create_task(self.sweeper.run())
+        try:
+            options = {'compression': 'deflate' if self.deflate else None}
+            if self.shard_count == 1:
+                async with websockets.serve(self.handler, self.host, self.port, **options):
+                    await self._stop.wait()
+                return
+            # shards share the main port and a replacement shard can bind its
+            # own port while the one it replaces drains
+            async with websockets.serve(
+                    self.handler, self.host, self.port, reuse_port=True, **options), \
+                    websockets.serve(
+                        self.handler, self.host, self.port + 1 + self.shard,
+                        reuse_port=True, **options):
+                await self._stop.wait()
+        finally:
+            sweeper.cancel()
 
     async def stop(self):
-        for handler in self.handlers.values():
-            await handler.stop()
+        for connections in self.handlers.values():
+            for handler in connections:
+                await handler.stop()
         self._stop.set()
+        if self._server_task is not None:
+            await self._server_task
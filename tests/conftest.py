@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the api's modules import each other top level, as they do when run from src/rest
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src', 'rest'), os.path.join(ROOT, 'src')]
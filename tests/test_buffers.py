@@ -0,0 +1,154 @@
+import asyncio
+import json
+from unittest import mock
+from buffers import ChannelBuffer, MessageBufferService
+from bus import LocalEventBus
+from utils import EventType
+
+
+def message(uid, channel_uid=1, board_uid=1):
+    return {'uid': uid, 'channel_uid': channel_uid, 'board_uid': board_uid,
+            'content': f'message {uid}'}
+
+
+def uids(body):
+    return [m['uid'] for m in json.loads(body)]
+
+
+def test_buffer_keeps_newest_in_order():
+    buffer = ChannelBuffer(maxlen=3)
+    for uid in (5, 1, 4, 2, 3, 4):
+        buffer.add(uid, str(uid))
+    assert buffer.uids == [3, 4, 5]
+    assert buffer.frames == ['3', '4', '5']
+    assert buffer.size == 3
+
+
+def test_buffer_pages():
+    buffer = ChannelBuffer(maxlen=10)
+    for uid in range(10, 20):
+        buffer.add(uid, str(uid))
+    assert buffer.before(None, 3) == ['17', '18', '19']
+    assert buffer.before(15, 2) == ['13', '14']
+    assert buffer.after(15, 2) == ['16', '17']
+    # older than what the buffer holds and it isn't the whole channel
+    assert buffer.before(12, 5) is None
+    assert buffer.after(5, 2) is None
+    buffer.complete = True
+    assert buffer.before(12, 5) == ['10', '11']
+    assert buffer.after(5, 2) == ['10', '11']
+
+
+def test_buffer_stops_being_complete_when_it_drops_messages():
+    buffer = ChannelBuffer(maxlen=2)
+    buffer.complete = True
+    for uid in range(3):
+        buffer.add(uid, str(uid))
+    assert not buffer.complete
+
+
+def test_service_answers_only_once_seeded():
+    buffers = MessageBufferService()
+    buffers.watch(1, 1)
+    # sent while the first page was read
+    buffers.append(1, message(100))
+    assert buffers(1, 50) is None
+    buffers.seed(1, 1, [message(uid) for uid in range(90, 100)], complete=True)
+    assert uids(buffers(1, 50)) == list(range(90, 101))
+    assert uids(buffers(1, 2, before=95)) == [93, 94]
+    assert uids(buffers(1, 2, after=95)) == [96, 97]
+    assert uids(buffers(1, 4, around=95)) == [93, 94, 96, 97]
+    assert (buffers.hits, buffers.misses) == (4, 1)
+
+
+def test_service_evicts_least_recently_used_channel():
+    buffers = MessageBufferService(max_bytes=1000)
+    buffers.seed(1, 1, [message(uid, 1) for uid in range(10)], complete=True)
+    buffers.seed(2, 1, [message(uid, 2) for uid in range(10)], complete=True)
+    assert buffers(2, 5) is not None
+    buffers.seed(3, 1, [message(uid, 3) for uid in range(10)], complete=True)
+    assert buffers(1, 5) is None
+    assert buffers(3, 5) is not None
+    assert buffers.size <= 1000
+
+
+def test_service_forget():
+    buffers = MessageBufferService()
+    buffers.seed(1, 1, [message(1)], complete=True)
+    buffers.forget(1)
+    assert buffers(1, 5) is None
+    assert buffers.size == 0
+
+
+class FakeBus(LocalEventBus):
+    def __init__(self):
+        super().__init__()
+        self.boards = {}
+
+    def subscribe(self, board_uids=(), user_uids=()):
+        for uid in board_uids:
+            self.boards[uid] = self.boards.get(uid, 0) + 1
+
+    def unsubscribe(self, board_uids=(), user_uids=()):
+        for uid in board_uids:
+            self.boards[uid] -= 1
+
+
+def test_service_follows_the_bus():
+    bus = FakeBus()
+    buffers = MessageBufferService()
+    buffers.follow(bus)
+    buffers.seed(1, 7, [message(1, 1, 7)], complete=True)
+    buffers.seed(2, 7, [message(1, 2, 7)], complete=True)
+    assert bus.boards == {7: 1}
+
+    async def run():
+        # sent through another worker
+        await bus.publish(EventType.MESSAGE_CREATE, 7, message(2, 1, 7))
+        await bus.publish(EventType.MESSAGE_CREATE, 8, message(3, 3, 8))
+        assert uids(buffers(1, 50)) == [1, 2]
+        await bus.publish(EventType.USER_UPDATE, 8, {'uid': 1, 'username': 'renamed'})
+        assert buffers(1, 50) is not None
+        await bus.publish(EventType.CHANNEL_DELETE, 7, {'uid': 1})
+        assert buffers(1, 50) is None
+        assert bus.boards == {7: 1}
+        await bus.publish(EventType.BOARD_DELETE, 7, {'uid': 7})
+        assert buffers(2, 50) is None
+        assert bus.boards == {7: 0}
+        assert buffers.size == 0
+
+    asyncio.run(run())
+
+
+def test_service_reseeds_old_buffers():
+    buffers = MessageBufferService(max_age=60)
+    with mock.patch('buffers.monotonic', return_value=0):
+        buffers.seed(1, 1, [message(1)], complete=True)
+    with mock.patch('buffers.monotonic', return_value=30):
+        assert uids(buffers(1, 50)) == [1]
+    with mock.patch('buffers.monotonic', return_value=60):
+        assert buffers(1, 50) is None
+        # the bus may have missed some, the page read next replaces them all
+        buffers.watch(1, 1)
+        assert buffers.size == 0
+        buffers.seed(1, 1, [message(2)], complete=True)
+        assert uids(buffers(1, 50)) == [2]
+
+
+def test_only_read_channels_are_buffered():
+    bus = FakeBus()
+    buffers = MessageBufferService()
+    buffers.follow(bus)
+    buffers.append(1, message(1, 1, 7))
+    assert (buffers.size, bus.boards) == (0, {})
+
+
+def test_renamed_member_drops_the_board_channels():
+    bus = FakeBus()
+    buffers = MessageBufferService()
+    buffers.follow(bus)
+    buffers.seed(1, 7, [message(1, 1, 7)], complete=True)
+    buffers.seed(2, 8, [message(1, 2, 8)], complete=True)
+    asyncio.run(bus.publish(EventType.USER_UPDATE, 7, {'uid': 3, 'username': 'renamed'}))
+    assert buffers(1, 50) is None
+    assert buffers(2, 50) is not None
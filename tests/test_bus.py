@@ -0,0 +1,166 @@
+import asyncio
+import json
+from unittest import mock
+from bus import EventHub, LocalEventBus, UnixEventBus
+from utils import EventType
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+        self.received = asyncio.Event()
+
+    async def __call__(self, event, board_uid, payload, user_uids):
+        self.events.append((event, board_uid, payload, user_uids))
+        self.received.set()
+
+    async def wait(self, count):
+        while len(self.events) < count:
+            self.received.clear()
+            await asyncio.wait_for(self.received.wait(), 2)
+
+
+def test_local_bus_delivers_to_every_listener():
+    async def run():
+        bus = LocalEventBus()
+        first, second = Recorder(), Recorder()
+        bus.listen(first)
+        bus.listen(second)
+        await bus.publish(EventType.BOARD_UPDATE, 1, {'uid': 1}, [5])
+        return first.events, second.events
+
+    first, second = asyncio.run(run())
+    assert first == second == [(EventType.BOARD_UPDATE, 1, {'uid': 1}, [5])]
+
+
+def test_local_bus_keeps_delivering_after_a_listener_fails():
+    async def run():
+        bus = LocalEventBus()
+
+        async def failing(event, board_uid, payload, user_uids):
+            raise RuntimeError('listener bug')
+
+        recorder = Recorder()
+        bus.listen(failing)
+        bus.listen(recorder)
+        await bus.publish(EventType.BOARD_UPDATE, 1, {'uid': 1})
+        return recorder.events
+
+    assert asyncio.run(run()) == [(EventType.BOARD_UPDATE, 1, {'uid': 1}, None)]
+
+
+async def start_hub(path, *subscriptions):
+    hub = EventHub(path)
+    await hub.start()
+    buses = []
+    for boards, users in subscriptions:
+        bus = UnixEventBus(path, reconnect_delay=0.05)
+        recorder = Recorder()
+        bus.listen(recorder)
+        bus.subscribe(board_uids=boards, user_uids=users)
+        await bus.start()
+        buses.append((bus, recorder))
+    # let the hub read the subscriptions
+    await asyncio.sleep(0.05)
+    return hub, buses
+
+
+def test_unix_bus_routes_by_board_and_user(tmp_path):
+    async def run():
+        hub, [(publisher, published), (board, on_board), (user, for_user)] = await start_hub(
+            str(tmp_path / 'bus.sock'), ([], []), ([1], []), ([], [7]))
+        await publisher.publish(EventType.MESSAGE_CREATE, 1, {'uid': 10})
+        await publisher.publish(EventType.BOARD_CREATE, 2, {'uid': 2}, [7])
+        await on_board.wait(1)
+        await for_user.wait(1)
+        await asyncio.sleep(0.05)
+        for bus in (publisher, board, user):
+            await bus.close()
+        await hub.close()
+        return published.events, on_board.events, for_user.events
+
+    published, on_board, for_user = asyncio.run(run())
+    assert published == []
+    assert on_board == [(EventType.MESSAGE_CREATE, 1, {'uid': 10}, None)]
+    assert for_user == [(EventType.BOARD_CREATE, 2, {'uid': 2}, [7])]
+
+
+def test_unix_bus_carries_events_over_64_kib(tmp_path):
+    async def run():
+        hub, [(bus, recorder)] = await start_hub(str(tmp_path / 'bus.sock'), ([1], []))
+        content = 'x' * 70000
+        await bus.publish(EventType.MESSAGE_CREATE, 1, {'content': content})
+        await bus.publish(EventType.MESSAGE_CREATE, 1, {'content': 'after'})
+        await recorder.wait(2)
+        await bus.close()
+        await hub.close()
+        return [payload['content'] for _, _, payload, _ in recorder.events], content
+
+    received, content = asyncio.run(run())
+    assert received == [content, 'after']
+
+
+def test_unix_bus_keeps_delivering_after_a_listener_fails(tmp_path):
+    async def run():
+        hub, [(bus, recorder)] = await start_hub(str(tmp_path / 'bus.sock'), ([1], []))
+        failures = []
+
+        async def failing(event, board_uid, payload, user_uids):
+            failures.append(payload)
+            raise RuntimeError('listener bug')
+
+        bus._listeners.insert(0, failing)
+        await bus.publish(EventType.MESSAGE_CREATE, 1, {'n': 1})
+        await bus.publish(EventType.MESSAGE_CREATE, 1, {'n': 2})
+        await recorder.wait(2)
+        await bus.close()
+        await hub.close()
+        return failures, recorder.events
+
+    failures, events = asyncio.run(run())
+    assert len(failures) == 2
+    assert [payload['n'] for _, _, payload, _ in events] == [1, 2]
+
+
+def test_unix_bus_resubscribes_when_the_hub_comes_back(tmp_path):
+    path = str(tmp_path / 'bus.sock')
+
+    async def run():
+        hub, [(publisher, _), (bus, recorder)] = await start_hub(path, ([], []), ([1], []))
+        await hub.close()
+        hub = EventHub(path)
+        await hub.start()
+        # both clients notice, reconnect and subscribe again
+        await asyncio.sleep(0.3)
+        await publisher.publish(EventType.MESSAGE_CREATE, 1, {'uid': 10})
+        await recorder.wait(1)
+        for client in (publisher, bus):
+            await client.close()
+        await hub.close()
+        return recorder.events
+
+    assert asyncio.run(run()) == [(EventType.MESSAGE_CREATE, 1, {'uid': 10}, None)]
+
+
+def test_hub_disconnects_a_client_that_stops_reading(tmp_path):
+    path = str(tmp_path / 'bus.sock')
+
+    async def run():
+        hub, [(publisher, _), (bus, recorder)] = await start_hub(path, ([], []), ([1], []))
+        # a worker that subscribed and then stopped reading
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(json.dumps({'t': 'sub', 'b': [1], 'u': []}).encode() + b'\n')
+        await asyncio.sleep(0.05)
+        with mock.patch('bus.MAX_BUFFERED', 1024 * 1024):
+            for n in range(20):
+                await publisher.publish(EventType.MESSAGE_CREATE, 1, {'content': 'x' * 200000})
+            await recorder.wait(20)
+        subscribers = len(hub.boards[1])
+        writer.close()
+        for client in (publisher, bus):
+            await client.close()
+        await hub.close()
+        return subscribers
+
+    # the one still reading is all that is left
+    assert asyncio.run(run()) == 1
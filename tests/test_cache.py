@@ -0,0 +1,91 @@
+import asyncio
+from unittest import mock
+from cache import LRUCache, SingleFlight
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_counts_hits_and_misses():
+    cache = LRUCache()
+    cache.set('a', None)
+    assert cache.get('a', False) is None
+    assert cache.get('b', False) is False
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_entries_expire():
+    cache = LRUCache(ttl=10)
+    with mock.patch('cache.monotonic', return_value=100):
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=60)
+    with mock.patch('cache.monotonic', return_value=111):
+        assert cache.get('a') is None
+        assert cache.get('b') == 2
+    assert len(cache) == 1
+
+
+def test_lru_discard_where():
+    cache = LRUCache()
+    for board_uid in (1, 2):
+        for user_uid in (10, 11):
+            cache.set((board_uid, user_uid), True)
+    cache.discard_where(lambda key: key[0] == 1)
+    assert sorted(cache._data) == [(2, 10), (2, 11)]
+
+
+def test_single_flight_shares_one_call():
+    calls = []
+
+    async def load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key * 2
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight('a', load, 'a') for _ in range(5)),
+                                       flight('b', load, 'b'))
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert results == ['aa'] * 5 + ['bb']
+    assert calls == ['a', 'b']
+    assert len(flight) == 0
+
+
+def test_single_flight_survives_a_cancelled_caller():
+    async def load():
+        await asyncio.sleep(0.01)
+        return 1
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight('a', load))
+        second = asyncio.ensure_future(flight('a', load))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == 1
+
+
+def test_single_flight_shares_errors():
+    async def load():
+        raise KeyError('gone')
+
+    async def run():
+        flight = SingleFlight()
+        return await asyncio.gather(flight('a', load), flight('a', load),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, KeyError) for r in results)
@@ -0,0 +1,87 @@
+import asyncio
+from messages import MessageWriteService
+
+
+class FakeDatabase:
+    """Stands in for DatabaseService running insert_messages, messages with
+    `bad` as their content make the whole write fail"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.batches = []
+
+    async def __call__(self, func, messages):
+        await asyncio.sleep(self.delay)
+        self.batches.append([m['uid'] for m in messages])
+        if any(m['content'] == 'bad' for m in messages):
+            raise RuntimeError('constraint violated')
+        # author 0 doesn't exist, so those messages aren't written
+        return {m['uid'] for m in messages if m['author_uid']}
+
+
+def write(writer, db, uid, author_uid=1, content='hello'):
+    return asyncio.ensure_future(writer(db, uid, 1, author_uid, content))
+
+
+def test_concurrent_messages_share_a_batch():
+    async def run():
+        db = FakeDatabase()
+        writer = MessageWriteService(max_batch=10, max_delay=0.05, writers=2)
+        results = await asyncio.gather(*(write(writer, db, uid) for uid in range(25)))
+        await writer.close()
+        return db.batches, results
+
+    batches, results = asyncio.run(run())
+    assert results == [True] * 25
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert sorted(uid for batch in batches for uid in batch) == list(range(25))
+
+
+def test_missing_author_is_not_committed():
+    async def run():
+        db = FakeDatabase()
+        writer = MessageWriteService(max_delay=0.01)
+        results = await asyncio.gather(write(writer, db, 1), write(writer, db, 2, author_uid=0))
+        await writer.close()
+        return results
+
+    assert asyncio.run(run()) == [True, False]
+
+
+def test_bad_message_only_fails_its_caller():
+    async def run():
+        db = FakeDatabase()
+        writer = MessageWriteService(max_delay=0.01)
+        futures = [write(writer, db, 1), write(writer, db, 2, content='bad'), write(writer, db, 3)]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        await writer.close()
+        return db.batches, results
+
+    batches, results = asyncio.run(run())
+    # the batch fails and is retried one message at a time
+    assert batches == [[1, 2, 3], [1], [2], [3]]
+    assert results[0] is True and results[2] is True
+    assert isinstance(results[1], RuntimeError)
+
+
+def test_close_writes_pending_messages():
+    async def run():
+        db = FakeDatabase(delay=0.01)
+        writer = MessageWriteService(max_delay=60)
+        futures = [write(writer, db, uid) for uid in range(3)]
+        await asyncio.sleep(0)
+        # without close they would wait a minute for the batch to fill
+        await asyncio.wait_for(writer.close(), 1)
+        results = [future.result() for future in futures]
+        try:
+            await writer(db, 4, 1, 1, 'late')
+        except RuntimeError:
+            refused = True
+        else:
+            refused = False
+        return db.batches, results, refused
+
+    batches, results, refused = asyncio.run(run())
+    assert batches == [[0, 1, 2]]
+    assert results == [True] * 3
+    assert refused
@@ -0,0 +1,32 @@
+import pytest
+from ordering import PositionConflict, position_changes
+
+CURRENT = {1: 0, 2: 1, 3: 2}
+
+
+def test_swap():
+    assert position_changes(CURRENT, {1: 1, 2: 0}) == [
+        {'uid': 1, 'position': 1}, {'uid': 2, 'position': 0}]
+
+
+def test_partial_set_into_a_free_position():
+    assert position_changes(CURRENT, {3: 5}) == [{'uid': 3, 'position': 5}]
+
+
+def test_unchanged_positions_are_left_out():
+    assert position_changes(CURRENT, {1: 0, 2: 5}) == [{'uid': 2, 'position': 5}]
+
+
+def test_duplicate_positions():
+    with pytest.raises(PositionConflict):
+        position_changes(CURRENT, {1: 4, 2: 4})
+
+
+def test_position_of_a_channel_not_being_moved():
+    with pytest.raises(PositionConflict):
+        position_changes(CURRENT, {1: 2})
+
+
+def test_unknown_channel():
+    with pytest.raises(PositionConflict):
+        position_changes(CURRENT, {9: 7})
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from aiohttp import web
+from permissions import Permissions, PermissionService, requires
+
+
+class FakeDatabase:
+    """Answers permission lookups from `roles` and channel lookups from
+    `channels`, counting the queries"""
+
+    def __init__(self, roles, channels=None):
+        self.roles = roles
+        self.channels = channels or {}
+        self.queries = 0
+
+    async def __call__(self, func, *args):
+        self.queries += 1
+        if func.__name__ == '_query_channel_board':
+            return self.channels.get(args[0])
+        board_uid, user_uid = args
+        return self.roles.get((board_uid, user_uid))
+
+
+class FakeUser:
+    def __init__(self, uid):
+        self.uid = uid
+
+
+class FakeContext:
+    def __init__(self, db, permissions, user_uid, **url_data):
+        self.services = {'db': db, 'permissions': permissions}
+        self.url_data = url_data
+        self.user = FakeUser(user_uid)
+
+
+class Handlers:
+    @requires(Permissions.SEND_MESSAGES, Permissions.MANAGE_CHANNELS)
+    async def manage(self, ctx):
+        return ctx.board_uid, ctx.permissions
+
+
+def call(ctx):
+    return asyncio.run(Handlers().manage(ctx))
+
+
+def test_requires_passes_permissions_on():
+    granted = Permissions.SEND_MESSAGES | Permissions.MANAGE_CHANNELS
+    db = FakeDatabase({(5, 1): granted}, channels={9: 5})
+    ctx = FakeContext(db, PermissionService(), 1, **{'channel.id': '9'})
+    assert call(ctx) == (5, granted)
+
+
+def test_requires_refuses_missing_permissions():
+    db = FakeDatabase({(5, 1): Permissions.SEND_MESSAGES})
+    with pytest.raises(web.HTTPForbidden) as e:
+        call(FakeContext(db, PermissionService(), 1, **{'board.id': '5'}))
+    assert 'MANAGE_CHANNELS' in e.value.reason
+
+
+def test_requires_refuses_users_not_on_the_board():
+    db = FakeDatabase({})
+    with pytest.raises(web.HTTPBadRequest):
+        call(FakeContext(db, PermissionService(), 1, **{'board.id': '5'}))
+
+
+def test_permissions_are_cached_until_invalidated():
+    async def run():
+        db = FakeDatabase({(5, 1): Permissions.VIEW_CHANNEL})
+        service = PermissionService()
+        first = await service(db, 5, 1)
+        await service(db, 5, 1)
+        # not being on a board is cached too
+        await service(db, 6, 1)
+        await service(db, 6, 1)
+        cached_queries = db.queries
+        db.roles[(5, 1)] = Permissions.SEND_MESSAGES
+        service.invalidate(board_uid=5)
+        return first, cached_queries, await service(db, 5, 1), await service(db, 6, 1)
+
+    first, cached_queries, after, other = asyncio.run(run())
+    assert first == Permissions.VIEW_CHANNEL
+    assert cached_queries == 2
+    assert after == Permissions.SEND_MESSAGES
+    assert other is None
@@ -0,0 +1,32 @@
+from responses import CachedBody, ResponseCacheService
+
+
+def test_bump_changes_the_version():
+    responses = ResponseCacheService(maxsize=10)
+    version = responses.version('board', 1)
+    assert responses.version('board', 1) == version
+    responses.bump('board', 1)
+    assert responses.version('board', 1) != version
+    assert responses.version('board', 2) != responses.version('board', 1)
+
+
+def test_versions_are_bounded_and_never_reused():
+    responses = ResponseCacheService(maxsize=2)
+    seen = {responses.version('board', 1)}
+    responses.bump('board', 1)
+    seen.add(responses.version('board', 1))
+    for uid in range(2, 10):
+        responses.version('board', uid)
+    assert len(responses.versions) == 2
+    # evicted, a body cached under an old version can't be served
+    assert responses.version('board', 1) not in seen
+
+
+def test_cached_body_etag():
+    body = CachedBody({'uid': 1})
+    assert body.etag == CachedBody({'uid': 1}).etag
+    assert body.etag != CachedBody({'uid': 2}).etag
+    assert body.matches(f'"other", W/{body.etag}')
+    assert body.matches('*')
+    assert not body.matches('"other"')
+    assert not body.matches(None)
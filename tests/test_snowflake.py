@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timedelta
+from time import time
+from unittest import mock
+from snowflake import (EPOCH, PROCESS_SHIFT, TIMESTAMP_SHIFT, WORKER_SHIFT,
+                       LocalSnowflakeGenerator, SnowflakeService, snowflake_to_time)
+
+
+def remote_snowflake(at, worker_id=1, increment=0):
+    """A snowflake laid out the way the snowflake host makes them"""
+    return (int(at * 1000) - EPOCH) << TIMESTAMP_SHIFT | worker_id << WORKER_SHIFT | increment
+
+
+def test_local_snowflake_decodes_to_when_it_was_made():
+    made = datetime.utcnow()
+    decoded = datetime.fromisoformat(snowflake_to_time(LocalSnowflakeGenerator()()))
+    assert abs(decoded - made) < timedelta(seconds=1)
+
+
+def test_local_snowflake_sorts_after_earlier_remote_one():
+    remote = remote_snowflake(time() - 0.01, increment=0xfff)
+    assert LocalSnowflakeGenerator()() > remote
+
+
+def test_local_snowflakes_increase():
+    generator = LocalSnowflakeGenerator()
+    snowflakes = [generator() for _ in range(10000)]
+    assert snowflakes == sorted(set(snowflakes))
+
+
+class SlowSnowflakeService(SnowflakeService):
+    def __init__(self, *args, delay=0.05, **kwargs):
+        super().__init__('http://snowflake.invalid/', *args, **kwargs)
+        self.delay = delay
+        self.fetches = 0
+
+    async def _fetch(self):
+        await asyncio.sleep(self.delay)
+        self.fetches += 1
+        return remote_snowflake(time(), increment=self.fetches)
+
+
+def test_empty_pool_only_waits_for_first_batch():
+    async def run():
+        service = SlowSnowflakeService(timeout=1, batch_size=32, high_watermark=128)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        snowflake = await service()
+        elapsed = loop.time() - start
+        service._refill_task.cancel()
+        return service, snowflake, elapsed
+
+    service, snowflake, elapsed = asyncio.run(run())
+    assert service.fallbacks == 0
+    assert snowflake >> WORKER_SHIFT & 0x1f == 1
+    # one batch is 0.05s, the whole refill would take four
+    assert elapsed < 0.15
+
+
+def test_pooled_snowflakes_expire_after_max_age():
+    async def run():
+        service = SlowSnowflakeService(delay=0, max_age=1)
+        with mock.patch('snowflake.monotonic', return_value=100):
+            service._pool.extend((100, n) for n in range(3))
+            fresh = await service()
+        with mock.patch('snowflake.monotonic', return_value=101.5):
+            service._expire()
+            left = len(service)
+        service._refill_task.cancel()
+        return fresh, left
+
+    fresh, left = asyncio.run(run())
+    assert fresh == 0
+    assert left == 0
+
+
+def test_local_snowflakes_carry_the_process_id():
+    service = SnowflakeService('http://snowflake.invalid/', process_id=5)
+    assert service._local() >> PROCESS_SHIFT & 0x1f == 5
@@ -0,0 +1,31 @@
+import json
+import zlib
+import msgpack
+from transport import Transport, ZLIB_SUFFIX, _packed
+
+
+def frame(seq):
+    return f'{{"s": {seq}, "op": 0, "t": "MESSAGE_CREATE", "d": {{"uid": 1}}}}'
+
+
+def test_msgpack_frames_match_packing_them_directly():
+    transport = Transport('msgpack')
+    for seq in (1, 127, 128, 70000, 2**40):
+        assert transport.encode(frame(seq)) == msgpack.packb(json.loads(frame(seq)))
+    assert transport.encode('{"op": 11}') == msgpack.packb({'op': 11})
+
+
+def test_msgpack_frames_are_converted_once_for_every_recipient():
+    _packed.cache_clear()
+    for seq in range(1, 101):
+        Transport('msgpack').encode(frame(seq))
+    assert _packed.cache_info().misses == 1
+
+
+def test_zlib_stream_shares_one_context():
+    transport = Transport(compress='zlib-stream')
+    decompress = zlib.decompressobj()
+    for seq in (1, 2):
+        data = transport.encode(frame(seq))
+        assert data.endswith(ZLIB_SUFFIX)
+        assert decompress.decompress(data).decode() == frame(seq)
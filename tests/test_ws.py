@@ -0,0 +1,311 @@
+import asyncio
+import json
+from unittest import mock
+import websockets
+from bus import LocalEventBus
+from metrics import DROPPED_FRAMES
+from transport import Transport
+from utils import EventType
+from snowflake import LocalSnowflakeGenerator
+from ws import (EventQueue, HeartbeatSweeper, RoamWebSocketHandler, WebSocketExtension,
+                shard_of)
+
+
+class FakeUser:
+    def __init__(self, uid, boards=()):
+        self.uid = uid
+        self.username = f'user{uid}'
+        self.discriminator = '0001'
+        self.boards = list(boards)
+
+
+class FakeUsers:
+    def __init__(self, *users):
+        self.users = {f'token{u.uid}': u for u in users}
+
+    async def __call__(self, services, token):
+        return self.users.get(token)
+
+
+async def fake_db(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+async def start_gateway(*users, **kwargs):
+    gateway = WebSocketExtension('127.0.0.1', 0, **kwargs)
+    services = {'users': FakeUsers(*users), 'db': fake_db,
+                'bus': LocalEventBus.service_factory()({})}
+    server = await websockets.serve(gateway.handler, '127.0.0.1', 0)
+    gateway.services = services
+    gateway.bus = services['bus']
+    gateway.bus.listen(gateway._deliver)
+    port = server.sockets[0].getsockname()[1]
+    return gateway, server, f'ws://127.0.0.1:{port}/'
+
+
+async def receive(websocket):
+    return json.loads(await asyncio.wait_for(websocket.recv(), 1))
+
+
+async def identify(url, token):
+    websocket = await websockets.connect(url)
+    assert (await receive(websocket))['op'] == 10
+    await websocket.send(json.dumps({'op': 2, 'd': {'token': token}}))
+    ready = await receive(websocket)
+    assert ready['t'] == 'READY'
+    return websocket, ready['d']['session_id']
+
+
+def test_resume_takes_over_a_connection_that_is_still_attached():
+    async def run():
+        gateway, server, url = await start_gateway(FakeUser(1))
+        old, session_id = await identify(url, 'token1')
+        handler = gateway.sessions[session_id]
+        handler.dispatch(None, json.dumps({'op': 0, 't': 'PING', 'd': 1}))
+        assert (await receive(old))['s'] == 1
+        handler.dispatch(None, json.dumps({'op': 0, 't': 'PING', 'd': 2}))
+
+        new = await websockets.connect(url)
+        await receive(new)
+        await new.send(json.dumps({'op': 6, 'd': {
+            'token': 'token1', 'session_id': session_id, 'seq': 1}}))
+        replayed = await receive(new)
+        resumed = await receive(new)
+        await asyncio.wait_for(old.wait_closed(), 1)
+        # the old connection going away doesn't detach the new one
+        await asyncio.sleep(0.05)
+        attached = handler.websocket is not None
+        replay = [json.loads(frame)['t'] for _, frame in handler.replay]
+        await new.close()
+        server.close()
+        return replayed, resumed, old.close_code, attached, replay
+
+    replayed, resumed, close_code, attached, replay = asyncio.run(run())
+    assert (replayed['s'], replayed['d']) == (2, 2)
+    assert resumed['t'] == 'RESUMED'
+    assert 's' not in resumed
+    assert replay == ['PING', 'PING']
+    assert close_code == 4011
+    assert attached
+
+
+def test_wrong_shard_is_told_its_port():
+    async def run():
+        uid = next(uid for uid in range(100) if shard_of(uid, 2) == 1)
+        gateway, server, url = await start_gateway(FakeUser(uid), shard=0, shard_count=2)
+        websocket = await websockets.connect(url)
+        hello = await receive(websocket)
+        await websocket.send(json.dumps({'op': 2, 'd': {'token': f'token{uid}'}}))
+        redirect = await receive(websocket)
+        await asyncio.wait_for(websocket.wait_closed(), 1)
+        server.close()
+        return hello, redirect, websocket.close_code
+
+    hello, redirect, close_code = asyncio.run(run())
+    assert hello['d']['shards'] == {'count': 2, 'first_port': 1}
+    assert redirect == {'op': 7, 'd': {'shard': 1, 'port': 2}}
+    assert close_code == 4013
+
+
+def test_sequential_uids_spread_over_shards():
+    generator = LocalSnowflakeGenerator(process_id=3)
+    uids = []
+    # one user a millisecond, so every increment is 0
+    for ms in range(400):
+        with mock.patch('snowflake.time', return_value=1600000000 + ms / 1000):
+            uids.append(generator())
+    for count in (2, 3, 4, 8):
+        shards = [0] * count
+        for uid in uids:
+            shards[shard_of(uid, count)] += 1
+        assert min(shards) > len(uids) / count * 0.75
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send(self, data):
+        self.sent.append(data)
+
+    async def close(self, code, reason):
+        self.close_code = code
+
+
+def test_want_boards_order():
+    handler = RoamWebSocketHandler(FakeUser(1), fake_db)
+    handler.boards.update({1, 2, 3, 4})
+    handler.want_boards([1, 2, 3, 9])
+    handler.want_boards([3], first=True)
+    handler.forget_board(2)
+    assert list(handler.pending_boards) == [3, 1]
+
+
+def test_boards_stream_in_chunks_after_queued_events():
+    fetched = []
+
+    async def db(func, uids, requester_uid):
+        fetched.append(list(uids))
+        return {uid: {'uid': uid} for uid in uids}
+
+    async def run():
+        handler = RoamWebSocketHandler(FakeUser(1), db, chunk_size=2)
+        handler.attach(FakeWebSocket(), Transport())
+        handler.boards.update(range(1, 6))
+        handler.want_boards(range(1, 6))
+        handler.want_boards([5], first=True)
+        stream = asyncio.ensure_future(handler._stream_boards())
+        await asyncio.sleep(0.01)
+        # the next chunk waits until the first one has been sent
+        first = list(fetched)
+        frames = []
+        while len(frames) < 5:
+            event, frame = await asyncio.wait_for(handler.events.get(), 1)
+            frames.append(json.loads(frame))
+        stream.cancel()
+        return first, frames
+
+    first, frames = asyncio.run(run())
+    assert first == [[5, 1]]
+    assert fetched == [[5, 1], [2, 3], [4]]
+    assert [f['d']['uid'] for f in frames] == [5, 1, 2, 3, 4]
+    assert all(f['t'] == 'BOARD_CREATE' for f in frames)
+
+
+def drain(queue):
+    async def run():
+        frames = []
+        while len(queue):
+            frames.append((await queue.get())[1])
+        return frames
+    return asyncio.run(run())
+
+
+def test_event_queue_coalesces_by_key():
+    queue = EventQueue()
+    update = EventType.BOARD_UPDATE
+    queue.put(update, 'board 1 v1', (update, 1))
+    queue.put(EventType.MESSAGE_CREATE, 'message')
+    queue.put(update, 'board 2 v1', (update, 2))
+    queue.put(update, 'board 1 v2', (update, 1))
+    assert len(queue) == 3
+    assert drain(queue) == ['message', 'board 2 v1', 'board 1 v2']
+
+
+def test_event_queue_drops_oldest_past_twice_maxsize():
+    queue = EventQueue(maxsize=2)
+    with mock.patch('ws.monotonic', return_value=50):
+        for n in range(3):
+            queue.put(EventType.MESSAGE_CREATE, str(n))
+    assert queue.over_since == 50
+    for n in range(3, 6):
+        queue.put(EventType.MESSAGE_CREATE, str(n))
+    assert (len(queue), queue.dropped) == (4, 2)
+    assert drain(queue) == ['2', '3', '4', '5']
+    assert queue.over_since is None
+
+
+def test_slow_connection_is_closed_with_4010():
+    async def run():
+        handler = RoamWebSocketHandler(FakeUser(1), fake_db, queue_size=2, slow_timeout=10)
+        websocket = FakeWebSocket()
+        handler.attach(websocket, Transport())
+        with mock.patch('ws.monotonic', return_value=100):
+            for n in range(3):
+                handler.dispatch(EventType.MESSAGE_CREATE, json.dumps({'op': 0, 'd': n}))
+        with mock.patch('ws.monotonic', return_value=105):
+            handler.dispatch(EventType.MESSAGE_CREATE, json.dumps({'op': 0, 'd': 3}))
+        await asyncio.sleep(0)
+        still_open = websocket.close_code is None
+        with mock.patch('ws.monotonic', return_value=111):
+            handler.dispatch(EventType.MESSAGE_CREATE, json.dumps({'op': 0, 'd': 4}))
+        await asyncio.sleep(0)
+        # nothing more is queued for a connection that is being closed
+        handler.dispatch(EventType.MESSAGE_CREATE, json.dumps({'op': 0, 'd': 5}))
+        return still_open, websocket.close_code, len(handler.events), handler.seq
+
+    still_open, close_code, queued, seq = asyncio.run(run())
+    assert still_open
+    assert close_code == 4010
+    assert queued == 4
+    # still numbered and kept for resuming
+    assert seq == 6
+
+
+def test_board_delete_reaches_every_online_member():
+    async def run():
+        gateway = WebSocketExtension('127.0.0.1', 0)
+        gateway.bus = LocalEventBus.service_factory()({})
+        handlers = []
+        for uid, boards in ((1, {7}), (2, {7, 8}), (3, {8})):
+            handler = RoamWebSocketHandler(FakeUser(uid), fake_db)
+            handler.attach(FakeWebSocket(), Transport())
+            handler.boards.update(boards)
+            gateway._connect(handler)
+            handlers.append(handler)
+        await gateway._deliver(EventType.BOARD_DELETE, 7, {'uid': 7, 'unavailable': False}, None)
+        frames = [[frame for _, frame in h.replay] for h in handlers]
+        return handlers, frames, gateway.boards
+
+    handlers, frames, boards = asyncio.run(run())
+    for member in frames[:2]:
+        assert [json.loads(f)['t'] for f in member] == ['BOARD_DELETE']
+    assert frames[2] == []
+    assert [h.boards for h in handlers] == [set(), {8}, {8}]
+    assert set(boards) == {8}
+
+
+def test_dropping_frames_closes_with_4010():
+    async def run():
+        handler = RoamWebSocketHandler(FakeUser(1), fake_db, queue_size=2, slow_timeout=10)
+        websocket = FakeWebSocket()
+        handler.attach(websocket, Transport())
+        before = sum(DROPPED_FRAMES._values.values())
+        with mock.patch('ws.monotonic', return_value=100):
+            for n in range(4):
+                handler.dispatch(EventType.MESSAGE_CREATE, json.dumps({'op': 0, 'd': n}))
+            await asyncio.sleep(0)
+            still_open = websocket.close_code is None
+            handler.dispatch(EventType.MESSAGE_CREATE, json.dumps({'op': 0, 'd': 4}))
+            await asyncio.sleep(0)
+        dropped = sum(DROPPED_FRAMES._values.values()) - before
+        return still_open, websocket.close_code, dropped, handler.missed(0)
+
+    still_open, close_code, dropped, missed = asyncio.run(run())
+    assert still_open
+    assert close_code == 4010
+    assert dropped == 1
+    # the dropped frame can still be resumed
+    assert len(missed) == 5
+
+
+class FakeSession:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.close_code = None
+
+    async def close(self, code, reason):
+        self.close_code = code
+
+
+def test_sweeper_closes_sessions_without_heartbeats():
+    async def run():
+        sweeper = HeartbeatSweeper(timeout=25)
+        silent, healthy = FakeSession('silent'), FakeSession('healthy')
+        with mock.patch('ws.monotonic', return_value=0):
+            sweeper.beat(silent)
+            sweeper.beat(healthy)
+        with mock.patch('ws.monotonic', return_value=20):
+            sweeper.beat(healthy)
+        with mock.patch('ws.monotonic', return_value=30):
+            task = asyncio.ensure_future(sweeper.run())
+            for _ in range(3):
+                await asyncio.sleep(0)
+        task.cancel()
+        return silent.close_code, healthy.close_code, len(sweeper)
+
+    silent, healthy, tracked = asyncio.run(run())
+    assert silent == 4009
+    assert healthy is None
+    assert tracked == 1